@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the old per-result DataFrame.append assembly of geocode results
+with the columnar results_to_frame used by every geocode path.
+
+Run from the repo root:
+
+    python benchmarks/bench_result_assembly.py
+    python benchmarks/bench_result_assembly.py --sizes 1000 10000 100000 --legacy-max 100000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.batch_geocoder import results_to_frame
+
+
+def synthetic_results(n: int):
+    """Builds n results shaped like batch_geocode output"""
+    return [{'attributes': {'ResultID': i, 'X': -118.0 - i * 1e-6, 'Y': 34.0 + i * 1e-6,
+                            'Score': 100, 'Status': 'M', 'Match_addr': '%d Main St, Los Angeles, CA' % i,
+                            'Addr_type': 'PointAddress'},
+             'location': {'x': -118.0 - i * 1e-6, 'y': 34.0 + i * 1e-6}}
+            for i in range(n)]
+
+
+def legacy_assembly(results: list):
+    """The loop geocode_csv used before, DataFrame.append spelled as pd.concat for current pandas"""
+    location_df = pd.DataFrame()
+
+    for i in results:
+        results_json = pd.json_normalize(i['attributes'])
+        location_df = pd.concat([location_df, results_json])
+
+    return location_df
+
+
+def timed(function, results):
+    start = time.perf_counter()
+    function(results)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='geocode result assembly benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--legacy-max', dest='legacy_max', type=int, default=10000,
+                        help='largest size the quadratic legacy loop is run at')
+    args = parser.parse_args()
+
+    print('%10s %14s %14s %10s' % ('results', 'legacy (s)', 'columnar (s)', 'speedup'))
+
+    for n in args.sizes:
+        results = synthetic_results(n)
+        columnar = timed(results_to_frame, results)
+
+        if n <= args.legacy_max:
+            legacy = timed(legacy_assembly, results)
+            print('%10d %14.3f %14.4f %9.0fx' % (n, legacy, columnar, legacy / columnar))
+        else:
+            print('%10d %14s %14.4f %10s' % (n, 'skipped', columnar, '-'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+Measures cold start time of gis_cli.py per command with python -X importtime.
+
+Local commands (--help, -rb, -sj) are run for real on tiny inputs in a temp
+directory. Commands that talk to ArcGIS Online cannot run offline, so for them
+only the imports their code path makes are timed, and they are skipped when the
+arcgis package is not installed.
+
+Run from the repo root:
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --repeat 10 --top 5
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+CLI = os.path.join(REPO, 'gis_cli.py')
+
+sys.path.insert(0, REPO)
+
+from src.breakdown import source_columns
+
+# modules each remote command imports on its way to the first request
+REMOTE_IMPORTS = {
+    'geocode': ['arcgis.gis', 'arcgis.geocoding'],
+    'upload': ['arcgis.gis', 'geopandas'],
+    'enrich': ['arcgis.gis', 'arcgis.features', 'src.local_enrich'],
+    'download': ['arcgis.gis', 'arcgis.features'],
+}
+
+
+def write_fixtures(directory: str):
+    """Writes a one site enriched csv, a points csv and a polygon GeoJSON, returns their paths"""
+    os.makedirs(os.path.join(directory, 'output', 'csv'), exist_ok=True)
+
+    enriched = os.path.join(directory, 'enriched.csv')
+    columns = ['OBJECTID'] + source_columns()
+    with open(enriched, 'w') as file:
+        file.write(','.join(columns) + '\n' + ','.join(['1'] + ['10'] * (len(columns) - 1)) + '\n')
+
+    points = os.path.join(directory, 'points.csv')
+    with open(points, 'w') as file:
+        file.write('Address,X,Y\n200 N Spring St,-118.2427,34.0537\n')
+
+    polygons = os.path.join(directory, 'polygons.geojson')
+    ring = [[-118.3, 34.0], [-118.2, 34.0], [-118.2, 34.1], [-118.3, 34.1], [-118.3, 34.0]]
+    with open(polygons, 'w') as file:
+        json.dump({'type': 'FeatureCollection',
+                   'features': [{'type': 'Feature', 'properties': {'zip': '90012'},
+                                 'geometry': {'type': 'Polygon', 'coordinates': [ring]}}]}, file)
+
+    return enriched, points, polygons
+
+
+def commands(directory: str):
+    """Maps a label to the python arguments that start that command"""
+    enriched, points, polygons = write_fixtures(directory)
+
+    runs = {
+        'help': [CLI, '--help'],
+        'breakdown (-rb)': [CLI, '-rb', enriched],
+        'spatial join (-sj)': [CLI, '-sj', points, '--polygons', polygons],
+    }
+
+    arcgis_installed = importlib.util.find_spec('arcgis') is not None
+    for command, modules in REMOTE_IMPORTS.items():
+        label = '%s (imports only)' % command
+        if not arcgis_installed:
+            runs[label] = None
+            continue
+        code = ('import sys; sys.path.insert(0, %r); sys.argv = [%r]; import gis_cli; '
+                'from src.arcgis_api import arcgis_api; import %s' % (REPO, CLI, ', '.join(modules)))
+        runs[label] = ['-c', code]
+
+    return runs
+
+
+def import_costs(stderr: str):
+    """Cumulative microseconds of every top level import in -X importtime output"""
+    costs = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):
+            costs[name.strip()] = int(cumulative)
+    return costs
+
+
+def run_once(arguments: list, directory: str):
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime'] + arguments, cwd=directory,
+                             capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr[-2000:])
+    return seconds, import_costs(process.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='gis_cli cold start benchmark')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per command, the median is reported')
+    parser.add_argument('--top', type=int, default=3, help='heaviest top level imports listed per command')
+    args = parser.parse_args()
+
+    print('%-26s %10s %12s  %s' % ('command', 'median (s)', 'imports (s)', 'heaviest imports'))
+
+    with tempfile.TemporaryDirectory() as directory:
+        for label, arguments in commands(directory).items():
+            if arguments is None:
+                print('%-26s %10s %12s  %s' % (label, '-', '-', 'skipped, arcgis is not installed'))
+                continue
+
+            runs = [run_once(arguments, directory) for _ in range(args.repeat)]
+            median = statistics.median(seconds for seconds, _ in runs)
+
+            costs = runs[-1][1]
+            heaviest = sorted(costs.items(), key=lambda cost: -cost[1])[:args.top]
+            print('%-26s %10.3f %12.3f  %s' % (label, median, sum(costs.values()) / 1e6,
+                                               ', '.join('%s %.2fs' % (name, cost / 1e6) for name, cost in heaviest)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks every arcgis_api command against the local mock ArcGIS Online in
+mock_arcgis.py, so performance can be compared offline and reproducibly.
+
+Wall time is mostly the simulated service latency, so it measures how well
+each command overlaps requests, sizes batches and pages, and handles throttling.
+Results are compared with benchmarks/baselines.json.
+
+Run from the repo root:
+
+    python benchmarks/bench_suite.py
+    python benchmarks/bench_suite.py --only geocode_csv download_csv
+    python benchmarks/bench_suite.py --save-baselines
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINES_PATH = os.path.join(BENCH_DIR, 'baselines.json')
+
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+from mock_arcgis import MockService, install
+
+import src.scheduler
+from src.arcgis_api import arcgis_api
+from src.breakdown import source_columns
+
+# slower than this many times the baseline is reported as a regression
+REGRESSION_RATIO = 1.25
+
+
+def addresses(n: int):
+    streets = ['Main St', 'Spring St', 'Figueroa St', 'Sunset Blvd', 'Vermont Ave']
+    return ['%d %s, Los Angeles, CA 900%02d' % (100 + i, streets[i % len(streets)], i % 90) for i in range(n)]
+
+
+def sites(n: int):
+    return pd.DataFrame({'Address': addresses(n), 'Name': ['Site %d' % i for i in range(n)],
+                         'X': np.linspace(-118.6, -117.9, n), 'Y': np.linspace(33.7, 34.3, n)})
+
+
+def enriched(n: int, seed: int = 0):
+    columns = source_columns()
+    values = np.random.default_rng(seed).integers(0, 500, size=(n, len(columns)))
+    df = pd.DataFrame(values, columns=columns)
+    df.insert(0, 'OBJECTID', np.arange(1, n + 1))
+    return df
+
+
+def scenarios(args):
+    """(name, setup, run) for every benchmark, setup(service) returns the argument run(api, argument) needs"""
+    n = args.rows
+
+    def address_csv(service):
+        sites(n)[['Address', 'Name']].to_csv('data.csv', index=False)
+        return 'data.csv'
+
+    def repeated_csv(service):
+        # a quarter as many addresses, each written four ways, as in csvs merged from several sources
+        df = sites(n // 4)[['Address', 'Name']]
+        spellings = [df, df.assign(Address=df.Address.str.upper()), df.assign(Address=df.Address.str.replace(',', ' ,')),
+                     df.assign(Address=df.Address.str.replace(' St', ' Street'))]
+        pd.concat(spellings, ignore_index=True).to_csv('data.csv', index=False)
+        return 'data.csv'
+
+    def address_df(service):
+        return sites(n)[['Address', 'Name']]
+
+    def hosted_layer(service):
+        return service.add_layer('Mock Sites', sites(args.layer_rows)).id
+
+    def hosted_item(service):
+        return service.add_layer('Mock Sites', sites(args.layer_rows))
+
+    def edited_sync(api, item):
+        # a full download, then 1% of the rows edited elsewhere and an incremental sync
+        api.download_feature_layer(item.id, sync=True)
+        layer = item.layers[0]
+        layer.touch(layer.df['OBJECTID'].iloc[::100].tolist())
+        api.download_feature_layer(item.id, sync=True)
+
+    def geocoded_csv(service):
+        sites(args.upload_rows).to_csv('Mock Upload.csv', index=False)
+        return 'Mock Upload.csv'
+
+    def changed_csv(service):
+        df = sites(args.upload_rows)
+        service.add_layer('Mock Upsert', df)
+        df.loc[df.index[::10], 'Name'] = 'renamed'
+        df.to_csv('Mock Upsert.csv', index=False)
+        return 'Mock Upsert.csv'
+
+    def enriched_csv(service):
+        enriched(args.sites).to_csv('Age and Race by Sex 3 Mile Buffer Mar 1.csv', index=False)
+        return 'Age and Race by Sex 3 Mile Buffer Mar 1.csv'
+
+    def enriched_series(service):
+        os.makedirs('series', exist_ok=True)
+        for month, name in enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']):
+            enriched(args.sites, month).to_csv('series/Age and Race by Sex 3 Mile Buffer %s 1.csv' % name, index=False)
+        return 'series'
+
+    return [
+        ('geocode_csv', address_csv, lambda api, path: api.geocode_csv(path, use_cache=False)),
+        ('geocode_csv --stream', address_csv, lambda api, path: api.geocode_csv(path, use_cache=False, stream=True)),
+        ('geocode_csv cached', address_csv,
+         lambda api, path: (api.geocode_csv(path), api.geocode_csv(path))),
+        ('geocode_csv repeated', repeated_csv, lambda api, path: api.geocode_csv(path, use_cache=False)),
+        ('geocode_df', address_df, lambda api, df: api.geocode_df(df, use_cache=False)),
+        ('mass_geocode_df', address_df, lambda api, df: api.mass_geocode_df(df, use_cache=False)),
+        ('geocode_csv throttled', address_csv,
+         lambda api, path: api.geocode_csv(path, max_workers=4 * args.capacity, use_cache=False)),
+        ('download_csv', hosted_layer, lambda api, item_id: api.download_feature_layer(item_id)),
+        ('download_csv --sync', hosted_item, edited_sync),
+        ('upload csv', geocoded_csv, lambda api, path: api.upload_as_feature_layer(path)),
+        ('upload --upsert', changed_csv, lambda api, path: api.upload_as_feature_layer(path, mode='upsert')),
+        ('print_breakdown', enriched_csv, lambda api, path: api.print_breakdown(path, per_site=True)),
+        ('print_breakdown series', enriched_series, lambda api, path: api.print_breakdown(path)),
+    ]
+
+
+def run_scenario(setup, run, args, keys_path: str):
+    """Runs one benchmark in a fresh working directory, mock service and scheduler"""
+    service = MockService(latency=args.latency, batch_limit=args.batch_limit,
+                          max_record_count=args.max_record_count, capacity=args.capacity)
+    install(service)
+    src.scheduler.SCHEDULER = src.scheduler.Scheduler()
+
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            os.makedirs('output/csv')
+            argument = setup(service)
+            api = arcgis_api(token_cache=False, keys_path=keys_path)
+
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                run(api, argument)
+            seconds = time.perf_counter() - start
+        finally:
+            os.chdir(cwd)
+
+    stats = service.stats()
+    return {'seconds': round(seconds, 3), 'requests': sum(stats['requests'].values()),
+            'throttled': sum(stats['throttled'].values())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='arcgis_api benchmarks against a mock ArcGIS Online')
+    parser.add_argument('--only', nargs='+', help='benchmark names to run, default all')
+    parser.add_argument('--rows', type=int, default=20000, help='addresses geocoded')
+    parser.add_argument('--layer-rows', dest='layer_rows', type=int, default=50000, help='rows in the downloaded layer')
+    parser.add_argument('--upload-rows', dest='upload_rows', type=int, default=5000, help='rows uploaded')
+    parser.add_argument('--sites', type=int, default=2000, help='sites per enriched csv broken down')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds every mock request takes')
+    parser.add_argument('--batch-limit', dest='batch_limit', type=int, default=1000, help='geocoder MaxBatchSize')
+    parser.add_argument('--max-record-count', dest='max_record_count', type=int, default=2000, help='layer maxRecordCount')
+    parser.add_argument('--capacity', type=int, default=8, help='requests in flight per endpoint before throttling')
+    parser.add_argument('--save-baselines', dest='save_baselines', action='store_true',
+                        help='store these results as the new baselines')
+    args = parser.parse_args()
+
+    config = {name: getattr(args, name) for name in
+              ['rows', 'layer_rows', 'upload_rows', 'sites', 'latency', 'batch_limit', 'max_record_count', 'capacity']}
+
+    with open(BASELINES_PATH) if os.path.exists(BASELINES_PATH) else contextlib.nullcontext() as file:
+        stored = json.load(file) if file else {'config': config, 'results': {}}
+    if stored['config'] != config and not args.save_baselines:
+        print('Settings differ from the stored baselines, comparisons are not like for like')
+
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False) as keys:
+        keys.write('arcgis_username: mock\narcgis_password: mock\n')
+
+    print('%-24s %10s %10s %10s %10s %10s' % ('benchmark', 'seconds', 'baseline', 'ratio', 'requests', 'throttled'))
+    results = {}
+    try:
+        for name, setup, run in scenarios(args):
+            if args.only and name not in args.only:
+                continue
+
+            result = results[name] = run_scenario(setup, run, args, keys.name)
+            baseline = stored['results'].get(name, {}).get('seconds')
+            ratio = result['seconds'] / baseline if baseline else None
+            flag = '  REGRESSION' if ratio and ratio > REGRESSION_RATIO else ''
+
+            print('%-24s %10.3f %10s %10s %10d %10d%s'
+                  % (name, result['seconds'], '%.3f' % baseline if baseline else '-',
+                     '%.2fx' % ratio if ratio else '-', result['requests'], result['throttled'], flag))
+    finally:
+        os.remove(keys.name)
+
+    if args.save_baselines:
+        if stored['config'] != config:
+            stored = {'config': config, 'results': {}}
+        stored['results'].update(results)
+        with open(BASELINES_PATH, 'w') as file:
+            json.dump(stored, file, indent=2)
+        print('Saved baselines to', BASELINES_PATH)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+In-process stand-in for the parts of the arcgis package arcgis_api uses, backed by a
+MockService that simulates ArcGIS Online: per request latency, the geocoder's batch
+limit, a layer's maxRecordCount and throttling (429 with Retry-After) once more
+requests are in flight than the service allows.
+
+    service = MockService(latency=0.02, capacity=8)
+    install(service)          # before arcgis_api first imports arcgis
+    api = arcgis_api(token_cache=False, keys_path=keys_yaml)
+
+Only what the CLI touches is modeled: login, content add/get/search/import_data,
+publish, get_geocoders, batch_geocode, FeatureLayer query/edit_features. Layers have
+editor tracking on and queries evaluate the where clauses the download and sync code sends.
+"""
+
+import itertools
+import json
+import re
+import sys
+import threading
+import time
+import types
+
+import numpy as np
+import pandas as pd
+
+# one comparison of a where clause, e.g. OBJECTID >= 2001 or EditDate > timestamp '2021-03-15 00:00:00'
+CLAUSE = re.compile(r"^(\w+)\s*(>=|<=|>|<|=)\s*(?:timestamp\s+'([^']+)'|(-?\d+(?:\.\d+)?))$", re.IGNORECASE)
+
+# edit date stamped on every row a layer is created with
+CREATED = pd.Timestamp('2021-03-01 12:00:00')
+
+
+def where_mask(df, where: str):
+    """
+    Rows of df matching a where clause made of 1=1 and field comparisons joined by AND, the forms
+    the download and sync code sends. Anything else is refused like the service refuses bad SQL
+    """
+    mask = np.ones(len(df), dtype=bool)
+    for clause in re.split(r'\s+AND\s+', where.replace('(', ' ').replace(')', ' ').strip(), flags=re.IGNORECASE):
+        clause = clause.strip()
+        if clause == '1=1':
+            continue
+
+        match = CLAUSE.match(clause)
+        if match is None or match.group(1) not in df:
+            raise HTTPError(400, 'Unable to perform query, invalid where clause %r' % where)
+
+        field, operator, timestamp, number = match.groups()
+        value = pd.Timestamp(timestamp) if timestamp is not None else float(number)
+        column = df[field]
+        mask &= {'>=': column >= value, '<=': column <= value, '>': column > value,
+                 '<': column < value, '=': column == value}[operator].to_numpy()
+    return mask
+
+
+class PropertyMap(dict):
+    """dict with attribute access, like arcgis' PropertyMap"""
+    def __getattr__(self, name):
+        try:
+            value = self[name]
+        except KeyError:
+            raise AttributeError(name)
+        return PropertyMap(value) if isinstance(value, dict) and not isinstance(value, PropertyMap) else value
+
+
+class Response(object):
+    def __init__(self, status_code: int, headers: dict):
+        self.status_code = status_code
+        self.headers = headers
+
+
+class HTTPError(Exception):
+    """Raised for simulated failures, carries a response like requests.HTTPError"""
+    def __init__(self, status_code: int, message: str, headers: dict = None):
+        super().__init__('%s (Error Code: %d)' % (message, status_code))
+        self.response = Response(status_code, headers or {})
+
+
+class MockService(object):
+    """
+    Simulated ArcGIS Online organization
+
+    Args:
+        latency (float): seconds every request takes
+        per_record (float): extra seconds per address geocoded or record returned / edited
+        batch_limit (int): MaxBatchSize the geocoder reports, larger batches are refused
+        max_record_count (int): maxRecordCount of every layer
+        capacity (int): requests in flight at once per endpoint before the service throttles
+        retry_after (float): Retry-After seconds sent with a throttled response
+    """
+    def __init__(self, latency: float = 0.02, per_record: float = 0.00001, batch_limit: int = 1000,
+                 max_record_count: int = 2000, capacity: int = 16, retry_after: float = 0.05):
+
+        self.latency = latency
+        self.per_record = per_record
+        self.batch_limit = batch_limit
+        self.max_record_count = max_record_count
+        self.capacity = capacity
+        self.retry_after = retry_after
+
+        self.items = {}
+        self.layers = {}
+        self.requests = {}
+        self.throttled = {}
+        self.records = 0
+        self._in_flight = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def serve(self, endpoint: str, records: int = 0):
+        """
+        Context for one request: throttles past capacity, otherwise sleeps the simulated latency
+        """
+        service = self
+
+        class _Request(object):
+            def __enter__(self):
+                with service._lock:
+                    service.requests[endpoint] = service.requests.get(endpoint, 0) + 1
+                    if service._in_flight.get(endpoint, 0) >= service.capacity:
+                        service.throttled[endpoint] = service.throttled.get(endpoint, 0) + 1
+                        raise HTTPError(429, 'Too many requests',
+                                        {'Retry-After': '%g' % service.retry_after})
+                    service._in_flight[endpoint] = service._in_flight.get(endpoint, 0) + 1
+                    service.records += records
+                time.sleep(service.latency + records * service.per_record)
+
+            def __exit__(self, *exc):
+                with service._lock:
+                    service._in_flight[endpoint] -= 1
+
+        return _Request()
+
+    def new_id(self):
+        return '%032x' % next(self._ids)
+
+    def add_layer(self, title: str, df):
+        """
+        Publishes a DataFrame as a hosted feature layer item, OBJECTID is added when missing
+        """
+        item = Item(self, title, 'Feature Layer')
+        layer = MockLayer(self, title, df)
+        item.layers = [layer]
+        self.layers[layer.url] = layer
+        self.items[item.id] = item
+        return item
+
+    def stats(self):
+        return {'requests': dict(self.requests), 'throttled': dict(self.throttled), 'records': self.records}
+
+
+class MockLayer(object):
+    """
+    Hosted feature layer, rows are kept in a DataFrame ordered by OBJECTID
+
+    Editor tracking is on: every add and update stamps EditDate, which sync downloads filter on
+    """
+    def __init__(self, service: MockService, name: str, df):
+
+        self.service = service
+        self.url = 'https://services.mock/arcgis/rest/services/%s/FeatureServer/0' % service.new_id()
+
+        df = df.reset_index(drop=True)
+        if 'OBJECTID' not in df:
+            df.insert(0, 'OBJECTID', np.arange(1, len(df) + 1))
+        if 'EditDate' not in df:
+            df['EditDate'] = CREATED
+        # OBJECTID first and the editor tracking date last, like a published layer
+        df = df[['OBJECTID'] + [column for column in df.columns if column not in ('OBJECTID', 'EditDate')] + ['EditDate']]
+
+        fields = [{'name': 'OBJECTID', 'type': 'esriFieldTypeOID'}] + \
+                 [{'name': re.sub(r'\W', '_', str(column)), 'type': 'esriFieldTypeString'} for column in df.columns[1:-1]] + \
+                 [{'name': 'EditDate', 'type': 'esriFieldTypeDate'}]
+        df.columns = [field['name'] for field in fields]
+
+        self.df = df
+        self._lock = threading.Lock()
+
+        self.properties = PropertyMap({
+            'name': name, 'maxRecordCount': service.max_record_count, 'objectIdField': 'OBJECTID',
+            'capabilities': 'Query,Editing', 'fields': fields, 'editFieldsInfo': {'editDateField': 'EditDate'},
+            'extent': {'xmin': -119.0, 'ymin': 33.0, 'xmax': -117.0, 'ymax': 35.0,
+                       'spatialReference': {'wkid': 4326}},
+        })
+
+    def query(self, where: str = '1=1', out_fields: str = '*', return_ids_only: bool = False,
+              as_df: bool = False, **kwargs):
+        with self._lock:
+            df = self.df
+
+        df = df[where_mask(df, where)]
+
+        if return_ids_only:
+            with self.service.serve('query'):
+                return {'objectIdFieldName': 'OBJECTID', 'objectIds': df['OBJECTID'].tolist()}
+
+        df = df.head(self.service.max_record_count)
+
+        if out_fields != '*':
+            df = df[[field for field in out_fields.split(',') if field in df]]
+
+        with self.service.serve('query', len(df)):
+            if as_df:
+                return df.copy()
+            return FeatureSet(df)
+
+    def edit_features(self, adds: list = None, updates: list = None, deletes: str = None, **kwargs):
+        records = len(adds or []) + len(updates or []) + len(deletes.split(',') if deletes else [])
+
+        with self.service.serve('edit', records), self._lock:
+            result = {'addResults': [], 'updateResults': [], 'deleteResults': []}
+
+            if adds:
+                start = int(self.df['OBJECTID'].max() or 0) + 1 if len(self.df) else 1
+                rows = pd.DataFrame([feature['attributes'] for feature in adds])
+                rows['OBJECTID'] = np.arange(start, start + len(rows))
+                rows['EditDate'] = pd.Timestamp.now().floor('s')
+                self.df = pd.concat([self.df, rows], ignore_index=True)
+                result['addResults'] = [{'success': True} for _ in adds]
+
+            if updates:
+                index = self.df.set_index('OBJECTID').index
+                for feature in updates:
+                    attributes = dict(feature['attributes'])
+                    row = index.get_loc(int(attributes.pop('OBJECTID')))
+                    for column, value in attributes.items():
+                        self.df.loc[row, column] = value
+                    self.df.loc[row, 'EditDate'] = pd.Timestamp.now().floor('s')
+                result['updateResults'] = [{'success': True} for _ in updates]
+
+            if deletes:
+                oids = [int(oid) for oid in deletes.split(',')]
+                self.df = self.df[~self.df['OBJECTID'].isin(oids)].reset_index(drop=True)
+                result['deleteResults'] = [{'success': True} for _ in oids]
+
+            return result
+
+    def touch(self, oids: list, when=None):
+        """Stamps rows as edited, like another user editing them, without a request"""
+        with self._lock:
+            self.df.loc[self.df['OBJECTID'].isin(oids), 'EditDate'] = pd.Timestamp(when or pd.Timestamp.now().floor('s'))
+
+
+class FeatureSet(object):
+    def __init__(self, df):
+        self.df = df
+
+    def to_dict(self):
+        return {'features': [{'attributes': row} for row in self.df.to_dict('records')]}
+
+
+class Item(object):
+    def __init__(self, service: MockService, title: str, item_type: str, text: str = None):
+
+        self.service = service
+        self.id = service.new_id()
+        self.title = title
+        self.type = item_type
+        self.text = text
+        self.layers = []
+
+    def publish(self, *args, **kwargs):
+        """Publishes a feature collection item, the rows come from its featureSet"""
+        features = json.loads(self.text)['featureCollection']['layers'][0]['featureSet']['features']
+        with self.service.serve('publish', len(features)):
+            return self.service.add_layer(self.title, pd.DataFrame([feature['attributes'] for feature in features]))
+
+    def update(self, item_properties: dict = None, **kwargs):
+        with self.service.serve('content'):
+            self.title = (item_properties or {}).get('title', self.title)
+            return True
+
+    def __repr__(self):
+        return '<Item title:"%s" type:%s>' % (self.title, self.type)
+
+
+class FeatureCollection(object):
+    def __init__(self, df):
+        self.properties = {'layerDefinition': {'geometryType': 'esriGeometryPoint'},
+                           'featureSet': {'features': [{'attributes': row} for row in df.to_dict('records')]}}
+
+
+class ContentManager(object):
+    def __init__(self, service: MockService):
+        self.service = service
+
+    def add(self, item_properties: dict, data: str = None, **kwargs):
+        with self.service.serve('content'):
+            item = Item(self.service, item_properties.get('title', 'untitled'),
+                        item_properties.get('type', 'File'), item_properties.get('text'))
+            self.service.items[item.id] = item
+            return item
+
+    def get(self, item_id: str):
+        with self.service.serve('content'):
+            return self.service.items.get(item_id)
+
+    def search(self, query: str, item_type: str = None, **kwargs):
+        title = re.sub(r'^title:"?|"$', '', query)
+        with self.service.serve('content'):
+            return [item for item in self.service.items.values()
+                    if title in item.title and (item_type is None or item.type == item_type)]
+
+    def import_data(self, df, **kwargs):
+        return FeatureCollection(df)
+
+
+class Geocoder(object):
+    def __init__(self, service: MockService):
+        self.url = 'https://geocode.mock/arcgis/rest/services/World/GeocodeServer'
+        self.properties = PropertyMap({'locatorProperties': {'MaxBatchSize': service.batch_limit}})
+
+
+def _install_modules(service: MockService):
+    class _Connection(object):
+        token = 'mock-token'
+
+    class GIS(object):
+        def __init__(self, url: str = None, username: str = None, password: str = None, token: str = None, **kwargs):
+            with service.serve('login'):
+                self.url = url
+                self.content = ContentManager(service)
+                self._con = _Connection()
+
+    def get_geocoders(gis):
+        with service.serve('content'):
+            return [Geocoder(service), Geocoder(service)]
+
+    def batch_geocode(addresses: list, source_country: str = None, geocoder=None, **kwargs):
+        if len(addresses) > service.batch_limit:
+            raise HTTPError(400, 'Batch of %d exceeds MaxBatchSize %d' % (len(addresses), service.batch_limit))
+
+        with service.serve('geocode', len(addresses)):
+            return [{'attributes': {'ResultID': i, 'Status': 'M', 'Score': 100.0, 'Match_addr': str(address).upper(),
+                                    'Addr_type': 'PointAddress', 'X': -118.0 - (hash(address) % 1000) * 1e-4,
+                                    'Y': 34.0 + (hash(address) % 777) * 1e-4},
+                     'location': {'x': -118.0, 'y': 34.0}}
+                    for i, address in enumerate(addresses)]
+
+    def FeatureLayer(url: str, gis=None):
+        return service.layers[url]
+
+    modules = {name: types.ModuleType(name) for name in
+               ['arcgis', 'arcgis.gis', 'arcgis.geocoding', 'arcgis.features', 'arcgis.geoenrichment']}
+    modules['arcgis.gis'].GIS = GIS
+    modules['arcgis.geocoding'].get_geocoders = get_geocoders
+    modules['arcgis.geocoding'].batch_geocode = batch_geocode
+    modules['arcgis.features'].FeatureLayer = FeatureLayer
+    modules['arcgis.features'].enrich_data = types.SimpleNamespace()
+    modules['arcgis.geoenrichment'].Country = types.SimpleNamespace()
+
+    for name, module in modules.items():
+        if '.' in name:
+            setattr(modules['arcgis'], name.split('.')[1], module)
+    return modules
+
+
+def install(service: MockService):
+    """Puts mock arcgis modules in sys.modules, replacing any real arcgis already imported"""
+    sys.modules.update(_install_modules(service))
@@ -11,12 +11,23 @@ Created on Sun Feb 21 18:10:32 2021
 # https://developers.arcgis.com/python/api-reference/arcgis.gis.toc.html#gis
 
 import argparse
+import cProfile
+import json
 import os
-from src.arcgis_api import *
+import sys
+from functools import partial
+from src.job_runner import DEFAULT_JOB_WORKERS, read_jobs, results_path, run_jobs
+from src.profiling import PROFILER
 
 
-def _parse_args():
-    parser = argparse.ArgumentParser(description='i-team arcgis api wrapper')
+class _JobParser(argparse.ArgumentParser):
+    """Parses job lines, a bad value fails that job instead of exiting the whole run"""
+    def error(self, message):
+        raise ValueError(message)
+
+
+def _parser(parser_class=argparse.ArgumentParser):
+    parser = parser_class(description='i-team arcgis api wrapper')
 
     # Not yet implemented.
     #
@@ -29,53 +40,359 @@ def _parse_args():
                         help='Example: python gis-cli.py -gc "data/addresses.csv"',
                         type=str)
     
+    parser.add_argument('--workers',
+                        help='Number of geocode batches, download pages or breakdown files processed at the same time. Example: python gis-cli.py -gc "data/addresses.csv" --workers 8',
+                        type=int)
+    
+    parser.add_argument('--no-cache', dest='no_cache',
+                        help='Geocode every address without reading or writing the local geocode cache',
+                        action='store_true')
+    
+    parser.add_argument('--refresh',
+                        help='Ignore cached geocode and enrich results and run them again',
+                        action='store_true')
+    
+    parser.add_argument('--stream',
+                        help='Geocode the csv in chunks, appending to the output as it goes. Reruns resume where a crashed run stopped',
+                        action='store_true')
+    
+    parser.add_argument('--chunksize',
+                        help='Rows per chunk when streaming. Example: python gis-cli.py -gc "data/addresses.csv" --stream --chunksize 10000',
+                        type=int, default=5000)
+    
     parser.add_argument('--upload_feature_layer', '-ufl',
-                        help='Example: python gis-cli.py -ufl "output/geocoded_addresses.csv"',
+                        help='Example: python gis-cli.py -ufl "output/geocoded_addresses.csv" (also .shp, .gpkg, .fgb or .zip)',
                         type=str)
                         
+    parser.add_argument('--append',
+                        help='Add csv rows whose --key is not in the existing layer of the same name. Example: python gis-cli.py -ufl "output/geocoded_addresses.csv" --append',
+                        action='store_const', const='append', dest='edit_mode')
+    
+    parser.add_argument('--upsert',
+                        help='Add new, update changed and delete removed csv rows in the existing layer of the same name',
+                        action='store_const', const='upsert', dest='edit_mode')
+    
+    parser.add_argument('--key',
+                        help='Column identifying a row for --append / --upsert',
+                        type=str, default='Address')
+                        
     parser.add_argument('--enrich', '-e',
                         help='Example: python gis-cli.py -e "Arcgis Feature Layer Name"',
                         type=str)
                                           
+    parser.add_argument('--local_enrich', '-le',
+                        help='Example: python gis-cli.py -le "output/csv/Geocoded Mobile Sites.csv" --block_groups "data/shp/block_groups.gpkg" --demographics "data/csv/block_group_race.csv" --radii 1 3 5',
+                        type=str)
+    
+    parser.add_argument('--coverage', '-cv',
+                        help='Deduplicated totals and per site marginal coverage of overlapping buffers. Example: python gis-cli.py -cv "output/csv/Geocoded Mobile Sites.csv" --block_groups "data/shp/block_groups.gpkg" --demographics "data/csv/block_group_race.csv" --radii 3',
+                        type=str)
+    
+    parser.add_argument('--block_groups',
+                        help='Shapefile or GeoPackage of block groups used by --local_enrich and --coverage',
+                        type=str)
+    
+    parser.add_argument('--demographics',
+                        help='Csv of race variables per block group, leave out if the block group file already has them',
+                        type=str)
+    
+    parser.add_argument('--block_group_key',
+                        help='Block group id column shared by --block_groups and --demographics',
+                        type=str, default='GEOID')
+    
+    parser.add_argument('--radii',
+                        help='Buffer distances in miles for --enrich, --local_enrich and --coverage. Example: python gis-cli.py -e "Geocoded Mobile Sites Mar 1" --radii 1 3 5',
+                        type=float, nargs='+', default=[3])
+    
+    parser.add_argument('--variable_sets',
+                        help='Variable lists in data/enrichment_variables to enrich with. Example: python gis-cli.py -e "Geocoded Mobile Sites Mar 1" --variable_sets race_variables',
+                        type=str, nargs='+', default=['race_variables'])
+                                          
     parser.add_argument('--download_feature_layer', '-dfl',
                     help='Example: python gis-cli.py -dfl "6a57ff95150f404d884bd782f690d7e6"',
                     type=str)
                     
+    parser.add_argument('--sync',
+                    help='Only download rows changed since the last download and merge them into the existing csv. Example: python gis-cli.py -dfl "6a57ff95150f404d884bd782f690d7e6" --sync',
+                    action='store_true')
+    
+    parser.add_argument('--since',
+                    help='Sync rows edited after this date instead of the last download, or rows after this OBJECTID for layers without editor tracking. Example: python gis-cli.py -dfl "6a57ff95150f404d884bd782f690d7e6" --since 2021-03-15',
+                    type=str)
+                    
+    parser.add_argument('--geometry',
+                    help='Download the layer with its shapes into output/shp (--format gpkg, fgb or parquet). Example: python gis-cli.py -dfl "6a57ff95150f404d884bd782f690d7e6" --geometry --out_sr 4326 --precision 5',
+                    action='store_true')
+    
+    parser.add_argument('--out_sr',
+                    help='Wkid the server projects downloaded shapes to, e.g. 4326',
+                    type=int)
+    
+    parser.add_argument('--max_offset',
+                    help='Let the server generalize downloaded shapes by up to this distance (output crs units)',
+                    type=float)
+    
+    parser.add_argument('--precision',
+                    help='Decimal places kept in downloaded coordinates',
+                    type=int)
+    
+    parser.add_argument('--quantize',
+                    help='Let the server snap downloaded vertices to a grid of this size (layer crs units)',
+                    type=float)
+                    
     parser.add_argument('--race_breakdown', '-rb',
-                    help='Example: python gis-cli.py -rb "output/Enriched Feature Layer.csv"',
+                    help='Example: python gis-cli.py -rb "output/Enriched Feature Layer.csv" or a directory / glob of enriched csvs',
+                    type=str)
+    
+    parser.add_argument('--per_site',
+                    help='Break down every site (OBJECTID) instead of only the totals. Example: python gis-cli.py -rb "output/Enriched Feature Layer.csv" --per_site',
+                    action='store_true')
+    
+    parser.add_argument('--format',
+                    help='Output format, csv or json for breakdowns and --pipeline, csv or parquet for downloads, gpkg, fgb or parquet for --geometry downloads',
+                    choices=['csv', 'json', 'parquet', 'gpkg', 'fgb'])
+    
+    parser.add_argument('--spatial_join', '-sj',
+                    help='Example: python gis-cli.py -sj "output/csv/Geocoded Mobile Sites.csv" --polygons "data/shp/zipcodes.gpkg"',
+                    type=str)
+    
+    parser.add_argument('--polygons',
+                    help='Shapefile or GeoPackage the points are joined to',
+                    type=str)
+    
+    parser.add_argument('--radius',
+                    help='Join every polygon within this many miles of a point instead of the polygon it falls in',
+                    type=float)
+    
+    parser.add_argument('--pipeline', '-p',
+                    help='Geocode, upload, enrich, download and break down a csv in one go, skipping stages whose inputs did not change. Example: python gis-cli.py -p "data/addresses.csv" --radii 1 3',
+                    type=str)
+    
+    parser.add_argument('--jobs',
+                    help='JSONL file of jobs, one json object of the flags above per line, run at the same time over one login. Example line: {"geocode": "data/addresses.csv", "stream": true}',
+                    type=str)
+    
+    parser.add_argument('--job_workers',
+                    help='Jobs from --jobs run at the same time',
+                    type=int, default=DEFAULT_JOB_WORKERS)
+    
+    parser.add_argument('--results',
+                    help='JSONL file the status and timing of every --jobs job is written to, defaults to <jobs>.results.jsonl',
                     type=str)
     
-    return parser.parse_args()
+    parser.add_argument('--profile',
+                    help='Save wall time per stage, requests, bytes, rows/s and credits used as a json trace (also opens in chrome://tracing or Perfetto). Example: python gis-cli.py -gc "data/addresses.csv" --profile output/profile.json',
+                    type=str, nargs='?', const='output/profile.json')
+    
+    parser.add_argument('--cprofile',
+                    help='Also save a cProfile dump of the run, read it with python -m pstats. Example: --profile --cprofile output/run.prof',
+                    type=str)
+    
+    parser.add_argument('--no-token-cache', dest='no_token_cache',
+                        help='Always log in with the keys file instead of reusing the cached login token',
+                        action='store_true')
+    
+    return parser
 
-def main():
-    """Access Arcgis Online API"""
-    args = _parse_args()
+
+def _parse_args():
+    return _parser().parse_args()
+
+
+def _job_argv(parser, job: dict):
+    """
+    The command line a job line stands for, e.g. {"geocode": "data/addresses.csv", "radii": 3} ->
+    ["--geocode=data/addresses.csv", "--radii", "3"]
+    """
+    actions = {}
+    for action in parser._actions:
+        if action.option_strings:
+            actions.setdefault(action.dest, []).append(action)
+    
+    unknown = [name for name in job if name not in actions or name == 'help']
+    if unknown:
+        raise ValueError('Unknown job options: ' + ', '.join(unknown))
+    if job.get('jobs') is not None:
+        raise ValueError('Jobs cannot run other job files')
+    
+    argv = []
+    for name, value in job.items():
+        if value is None:
+            continue
+        
+        options = actions[name]
+        if len(options) > 1 or options[0].nargs == 0:
+            # switches, and flags sharing a destination such as --append / --upsert (edit_mode)
+            switches = [action for action in options if action.const == value or
+                        (isinstance(value, bool) and action.const is True)]
+            if not switches:
+                raise ValueError('%s takes %s, not %r' % (name, ' or '.join(
+                    json.dumps(action.const) for action in options), value))
+            if value is not False:
+                argv.append(switches[0].option_strings[-1])
+            continue
+        
+        option = max(options[0].option_strings, key=len)
+        if options[0].nargs in ('+', '*'):
+            argv += [option] + [str(item) for item in (value if isinstance(value, list) else [value])]
+        else:
+            argv.append('%s=%s' % (option, value))
+    return argv
+
+
+def _job_args(parser, job: dict):
+    """
+    Parses a job line with the command line parser, so its flags get the same types, choices and
+    defaults, e.g. {"geocode": "data/addresses.csv"}
+    """
+    return parser.parse_args(_job_argv(parser, job))
+
+
+# flags that select what a run does, one per run or job
+COMMANDS = ['pipeline', 'geocode', 'upload_feature_layer', 'enrich', 'local_enrich',
+            'coverage', 'download_feature_layer', 'race_breakdown', 'spatial_join']
+
+# what --format each command can write, the first is its default. Commands not listed write one fixed format
+FORMATS = {
+    'pipeline': ['csv', 'json'],
+    'download_feature_layer': ['csv', 'parquet'],
+    'race_breakdown': ['csv', 'json'],
+}
+
+# spatial files -dfl --geometry can write, the first is the default
+GEOMETRY_FORMATS = ['gpkg', 'fgb', 'parquet']
+
+
+def _check_args(args):
+    """Returns why args cannot run, None when they can"""
+    if all(getattr(args, command) is None for command in COMMANDS):
+        return 'No command given, see --help'
+    if args.local_enrich is not None and args.block_groups is None:
+        return '--block_groups is required with --local_enrich'
+    if args.coverage is not None and args.block_groups is None:
+        return '--block_groups is required with --coverage'
+    if args.spatial_join is not None and args.polygons is None:
+        return '--polygons is required with --spatial_join'
+    if args.geometry and args.download_feature_layer is None:
+        return '--geometry only works with --download_feature_layer'
+    if args.geometry and args.format is not None and args.format not in GEOMETRY_FORMATS:
+        return '--geometry downloads are written as %s, not %s' % (', '.join(GEOMETRY_FORMATS), args.format)
     
-    arcgis = arcgis_api()
+    command = next(command for command in COMMANDS if getattr(args, command) is not None)
+    if args.format is not None and not args.geometry and args.format not in FORMATS.get(command, []):
+        if command not in FORMATS:
+            return '--%s does not take --format' % command
+        return '--%s writes %s, not %s' % (command, ' or '.join(FORMATS[command]), args.format)
+    return None
+
+
+def run(arcgis, args):
+    """Runs the one command selected in args and returns what it produced"""
+    
+    problem = _check_args(args)
+    if problem is not None:
+        raise ValueError(problem)
+    
+    # leave each command its own default when --workers is not given
+    workers = {} if args.workers is None else {'max_workers': args.workers}
 
     # if args.filename is None:
     #     print('No filename provided')
     #     return
     
+    if args.pipeline is not None:
+        return arcgis.pipeline(args.pipeline, refresh=args.refresh, distances=args.radii,
+                               variable_sets=args.variable_sets, key=args.key, per_site=args.per_site,
+                               output_format=args.format or 'csv', stream=args.stream, **workers)
+    
     if args.geocode is not None:
-        arcgis.geocode_csv(args.geocode)
-        return
+        return arcgis.geocode_csv(args.geocode, **workers,
+                                  use_cache=not args.no_cache, refresh=args.refresh,
+                                  stream=args.stream, chunksize=args.chunksize)
     
     if args.upload_feature_layer is not None:
-        arcgis.upload_as_feature_layer(args.upload_feature_layer)
-        return
+        return arcgis.upload_as_feature_layer(args.upload_feature_layer, mode=args.edit_mode, key=args.key,
+                                              **workers)
         
     if args.enrich is not None:
-        arcgis.enrich(args.enrich)
-        return
+        return arcgis.enrich(args.enrich, refresh=args.refresh,
+                             distances=args.radii, variable_sets=args.variable_sets)
+        
+    if args.local_enrich is not None:
+        return arcgis.local_enrich(args.local_enrich, args.block_groups, args.demographics,
+                                   radii=args.radii, key=args.block_group_key)
+        
+    if args.coverage is not None:
+        return arcgis.coverage(args.coverage, args.block_groups, args.demographics,
+                               radii=args.radii, key=args.block_group_key)
+        
+    if args.download_feature_layer is not None and args.geometry:
+        return arcgis.download_feature_layer_geometry(args.download_feature_layer, args.format or GEOMETRY_FORMATS[0], **workers,
+                                                      out_sr=args.out_sr, max_allowable_offset=args.max_offset,
+                                                      geometry_precision=args.precision, quantize=args.quantize)
         
     if args.download_feature_layer is not None:
-        arcgis.download_feature_layer(args.download_feature_layer)
-        return
+        return arcgis.download_feature_layer(args.download_feature_layer, **workers,
+                                             sync=args.sync, since=args.since, output_format=args.format or 'csv')
         
     if args.race_breakdown is not None:
-        arcgis.print_breakdown(args.race_breakdown)
-        return
+        return arcgis.print_breakdown(args.race_breakdown, per_site=args.per_site, output_format=args.format or 'csv',
+                                      **workers)
+        
+    if args.spatial_join is not None:
+        return arcgis.spatial_join(args.spatial_join, args.polygons, radius=args.radius)
+
+
+def run_job_file(arcgis, parser, jobs_path: str, output_path: str = None, max_workers: int = DEFAULT_JOB_WORKERS):
+    """Runs every job of a JSONL job file over the one arcgis session"""
+    
+    output_path = output_path or results_path(jobs_path)
+    results = run_jobs(read_jobs(jobs_path), lambda job: run(arcgis, _job_args(parser, job)),
+                       output_path, max_workers=max_workers)
+    
+    failed = [result['line'] for result in results if result['status'] != 'ok']
+    print(len(results) - len(failed), 'of', len(results), 'jobs succeeded, results saved to', output_path)
+    if failed:
+        print('Failed jobs on lines:', ', '.join(str(line) for line in failed))
+    return results
+
+
+def main():
+    """Access Arcgis Online API"""
+    parser = _parser()
+    args = parser.parse_args()
+    
+    # imported after parsing so --help and bad flags return straight away
+    from src.arcgis_api import arcgis_api
+    
+    arcgis = arcgis_api(token_cache=not args.no_token_cache)
+    
+    if args.jobs is not None:
+        command = partial(run_job_file, arcgis, _parser(_JobParser), args.jobs, args.results, args.job_workers)
+    else:
+        problem = _check_args(args)
+        if problem is not None:
+            print(problem)
+            return
+        command = partial(run, arcgis, args)
+    
+    if args.profile is not None:
+        PROFILER.enable()
+    
+    profiler = cProfile.Profile() if args.cprofile is not None else None
+    try:
+        if profiler is not None:
+            profiler.runcall(command)
+        else:
+            command()
+    finally:
+        # written even when the run fails, that is when the trace is needed most
+        if profiler is not None:
+            profiler.dump_stats(args.cprofile)
+            print('Saved cProfile dump to', args.cprofile)
+        if args.profile is not None:
+            arcgis.record_credits('end')
+            PROFILER.save(args.profile, command=sys.argv[1:])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,135 @@
+import re
+import string
+
+import numpy as np
+import pandas as pd
+
+# USPS standard abbreviations for street suffixes, directionals and unit designators
+SUFFIXES = {
+    'AVENUE': 'AVE', 'AV': 'AVE', 'STREET': 'ST', 'STR': 'ST', 'BOULEVARD': 'BLVD', 'DRIVE': 'DR',
+    'ROAD': 'RD', 'LANE': 'LN', 'COURT': 'CT', 'PLACE': 'PL', 'PARKWAY': 'PKWY', 'HIGHWAY': 'HWY',
+    'CIRCLE': 'CIR', 'TERRACE': 'TER', 'TRAIL': 'TRL', 'SQUARE': 'SQ', 'EXPRESSWAY': 'EXPY',
+    'FREEWAY': 'FWY', 'PLAZA': 'PLZ',
+}
+DIRECTIONS = {
+    'NORTH': 'N', 'SOUTH': 'S', 'EAST': 'E', 'WEST': 'W',
+    'NORTHEAST': 'NE', 'NORTHWEST': 'NW', 'SOUTHEAST': 'SE', 'SOUTHWEST': 'SW',
+}
+UNITS = {
+    'APARTMENT': 'APT', 'SUITE': 'STE', 'BUILDING': 'BLDG', 'FLOOR': 'FL', 'ROOM': 'RM', 'NUMBER': 'UNIT',
+}
+ABBREVIATIONS = dict(SUFFIXES, **DIRECTIONS, **UNITS)
+
+_UNIT_WORDS = {'APT', 'STE', 'UNIT', 'BLDG', 'FL', 'RM'}
+_JOINED = re.compile(r'([-/])')
+_ZIP4 = re.compile(r'(\d{5})-\d{4}')
+
+# punctuation other than # , / - . ' becomes a space, a one to one table keeps str.translate on its fast path
+_PUNCTUATION = str.maketrans({character: ' ' for character in string.punctuation if character not in "#,/-.'"})
+
+# the distinct values are joined into one string and cut into words once, so every step is a
+# single C level pass or one list comprehension rather than a chain of regex calls per value
+_SEPARATOR = '\x00'
+
+# component columns a canonical key is built from when the csv has them
+COMPONENTS = ['Street', 'City', 'State', 'Zipcode']
+
+
+def _joined_word(word: str):
+    """
+    Abbreviates both sides of "NORTH-WEST" style words, "90012-1234" becomes "90012"
+    """
+    match = _ZIP4.fullmatch(word)
+    if match:
+        return match.group(1)
+    return ''.join(ABBREVIATIONS.get(piece, piece) for piece in _JOINED.split(word))
+
+
+def _clean(values, abbreviate: bool = False):
+    """
+    Upper case, no periods or apostrophes, other punctuation as spaces, single spaces, no spaces around commas.
+    abbreviate also applies the USPS abbreviations, unit designators and five digit ZIPs
+
+    Returns a list of cleaned strings, one per value
+    """
+    text = (' %s ' % _SEPARATOR).join(str(value).replace(_SEPARATOR, ' ') for value in values)
+    # periods and apostrophes vanish, ',' and '#' become words of their own
+    text = text.replace('.', '').replace("'", '').replace(',', ' , ').replace('#', ' # ')
+    words = text.upper().translate(_PUNCTUATION).split()
+
+    if abbreviate:
+        words = [ABBREVIATIONS.get(word, word) if '-' not in word and '/' not in word else _joined_word(word)
+                 for word in words]
+
+        if '#' in words:
+            # "STE #5" -> "STE 5", a lone "#5" -> "UNIT 5"
+            words = [word for position, word in enumerate(words)
+                     if word != '#' or position == 0 or words[position - 1] not in _UNIT_WORDS]
+            words = ['UNIT' if word == '#' else word for word in words]
+
+    text = ' '.join(words).replace(' ,', ',').replace(', ', ',')
+    text = text.replace(' ' + _SEPARATOR, _SEPARATOR).replace(_SEPARATOR + ' ', _SEPARATOR)
+    return [value.strip(',') for value in text.split(_SEPARATOR)]
+
+
+def _unique_map(values, normalize):
+    """
+    Runs normalize over the distinct values only and maps the result back, repeats are common
+    """
+    values = pd.Series(values).reset_index(drop=True)
+    codes, uniques = pd.factorize(values)
+    normalized = np.array(normalize(uniques.tolist()) + [None] if len(uniques) else [None], dtype=object)
+
+    # code -1 (missing) picks the trailing None
+    return pd.Series(normalized[codes], dtype='string')
+
+
+def normalize_streets(streets):
+    """
+    example: "1000 Vin Scully Avenue, Suite #5" -> "1000 VIN SCULLY AVE,STE 5"
+    """
+    return _unique_map(streets, lambda streets: _clean(streets, abbreviate=True))
+
+
+def _zip5(zipcode):
+    match = re.match(r'\d{1,5}', str(zipcode).strip())
+    return match.group().zfill(5) if match else None
+
+
+def zip5(zipcodes):
+    """
+    Five digit ZIP codes as text, ZIP+4 is cut and zips read as numbers get their leading zeros back
+
+    example: [90012, "90044-1234", 2134.0] -> ["90012", "90044", "02134"]
+    """
+    return _unique_map(zipcodes, lambda zipcodes: [_zip5(zipcode) for zipcode in zipcodes])
+
+
+def normalize_addresses(addresses):
+    """
+    Canonical keys for one line addresses, so trivially different spellings collapse to one key
+
+    example: " 1000 Vin Scully Avenue. ,Los Angeles, CA,90012-1234" -> "1000 VIN SCULLY AVE,LOS ANGELES,CA,90012"
+
+    Missing addresses get a missing key
+    """
+    return _unique_map(addresses, lambda addresses: _clean(addresses, abbreviate=True))
+
+
+def address_keys(df, address: str = 'Address'):
+    """
+    Canonical key of every row, built from Street, City, State and Zipcode when the csv has them
+
+    Rows missing a Street fall back to the normalized one line address column.
+    """
+    fallback = normalize_addresses(df[address]) if address in df else pd.Series(pd.NA, index=range(len(df)),
+                                                                                 dtype='string')
+    if not all(column in df for column in COMPONENTS):
+        return fallback
+
+    city = _unique_map(df['City'], _clean)
+    state = _unique_map(df['State'], _clean)
+    keys = normalize_streets(df['Street']) + ',' + city.fillna('') + ',' + state.fillna('') + ',' + \
+        zip5(df['Zipcode']).fillna('')
+
+    return keys.fillna(fallback)
@@ -1,26 +1,58 @@
+import glob
+import os
+import threading
+import time
 import yaml # handles login keys
-import tokenize # handles token errors
 import json 
+import hashlib
 import shutil # file manager
-import pickle # python data structure loader
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import geopandas as gpd
 import pandas as pd
-from arcgis.gis import GIS # login manager'
-from arcgis.geocoding import geocode, batch_geocode , get_geocoders# geocode
-from arcgis.features import FeatureLayer # access layer
-from arcgis.features import enrich_data
-from arcgis.geoenrichment import Country
+
+from .address import address_keys
+from .batch_geocoder import DEFAULT_WORKERS, geocode_addresses, results_to_frame
+from .breakdown import OUTPUT_PREFIX, SITE_COLUMN, breakdown_file, breakdown_files, breakdown_inputs, breakdown_table
+from .cache import (CACHE_DIR, CATALOG_PATH, CATALOG_TTL, EnrichCache, GeocodeCache, clear_token, fingerprint,
+                    load_json, load_token, save_json, save_token)
+from .feature_download import (DEFAULT_WORKERS as DOWNLOAD_WORKERS, download_csv, download_geodata, download_parquet, iter_pages,
+                               sync_csv)
+from .feature_edit import DEFAULT_WORKERS as EDIT_WORKERS, apply_edits, diff_layer, field_names, find_layer, to_features
+from .pipeline import PipelineState, file_fingerprint, state_path
+from .profiling import PROFILER, measure
+from .scheduler import request
+
+# arcgis, geopandas and shapely take seconds to import, so they are imported inside the
+# methods that use them and --help or a local breakdown never pay for them
+
+# overridable, e.g. to point the benchmarks at a test portal
+PORTAL_URL = os.environ.get('ARCGIS_PORTAL_URL', "http://lahub.maps.arcgis.com/home/organization.html")
+KEYS_PATH = os.environ.get('ARCGIS_KEYS_PATH', '../keys.yaml')
+
+# rows read, geocoded and appended per step when streaming a csv
+STREAM_CHUNKSIZE = 5000
 
 
 class arcgis_api(object):
     """
     Python class for common arcgis workflows 
     """
-    def __init__(self):
+    def __init__(self, token_cache: bool = True, portal_url: str = PORTAL_URL, keys_path: str = KEYS_PATH):
 
         self.user_name = "username"
         self.password = "password"
+        
+        # reuse a cached login token between runs
+        self.token_cache = token_cache
+        
+        self.portal_url = portal_url
+        self.keys_path = keys_path
+        
+        # created on first use and shared by every method on this instance
+        self._gis = None
+        self._geocoders = None
+        self._session_lock = threading.Lock()
 
     def read_df(self, csv_path: str):
         """
@@ -36,136 +68,284 @@ class arcgis_api(object):
     
     def connect_gis(self):
         """
-        Connects to arcgis online account
+        Connects to arcgis online account, the connection is made once and reused by later calls
 
         Args:
             yaml file with keys must be outside of directory
 
         example: see yaml example
         """
-        with open(r'../keys.yaml') as file:
-            	keys = yaml.load(file, Loader=yaml.FullLoader)
+        with self._session_lock:
+            if self._gis is None:
+                with measure('login'):
+                    self._gis = self._login()
+                
+                if PROFILER.enabled:
+                    PROFILER.watch_session(getattr(self._gis._con, '_session', None))
+                    self.record_credits('start')
             
+        return self._gis
+    
+    def record_credits(self, label: str):
+        """
+        Notes the organization's available credits on the --profile trace as label ('start' or 'end')
+
+        Only administrators can see credits, for other accounts nothing is recorded
+        """
+        if self._gis is None or not PROFILER.enabled:
+            return
+        
         try:
-            gis = GIS(url="http://lahub.maps.arcgis.com/home/organization.html",
-                      username=keys['arcgis_username'],password=keys['arcgis_password'])
-            
-            print("Successful Connection to AGOL API: ",type(gis.content))
+            credits = self._gis.admin.credits.credits
+        except Exception:
+            credits = None
+        PROFILER.record_credits(label, credits)
+    
+    def _login(self):
+        from arcgis.gis import GIS # login manager
+        
+        with open(self.keys_path) as file:
+            	keys = yaml.load(file, Loader=yaml.FullLoader)
+        
+        username = keys['arcgis_username']
+        
+        token = load_token(self.portal_url, username) if self.token_cache else None
+        if token is not None:
+            try:
+                gis = request('login', GIS, url=self.portal_url, token=token)
+                print("Reusing Cached AGOL Login: ",type(gis.content))
+                return gis
+            except Exception:
+                # expired or revoked early, fall back to a fresh login
+                clear_token()
             
-        except tokenize.TokenError:
-            pass
+        # transient failures are retried, a wrong password or an unreachable portal is raised
+        gis = request('login', GIS, url=self.portal_url,
+                      username=username, password=keys['arcgis_password'])
+        
+        print("Successful Connection to AGOL API: ",type(gis.content))
         
-        except:
-            print('Other Error')
+        if self.token_cache:
+            save_token(self.portal_url, username, gis._con.token)
             
         return gis
+    
+    def get_geocoders(self):
+        """
+        Returns the geocoders available to the account, looked up once per session
+
+        example: geocoder = gis.get_geocoders()[1]
+        """
+        from arcgis.geocoding import get_geocoders
+        
+        gis = self.connect_gis()
+        
+        with self._session_lock:
+            if self._geocoders is None:
+                with measure('geocoder discovery'):
+                    self._geocoders = request('content', get_geocoders, gis)
+            
+        return self._geocoders
 
-    def geocode_csv(self, csv_path: str):
+    def geocode_csv(self, csv_path: str, max_workers: int = DEFAULT_WORKERS,
+                    use_cache: bool = True, refresh: bool = False,
+                    stream: bool = False, chunksize: int = STREAM_CHUNKSIZE):
         """
         Geocodes 'Address' column in a csv and returns the same csv with lat longs in the output folder
 
         Args:
             csv_path (str): path to csv that you want to geocode
+            max_workers (int): number of batches geocoded at the same time
+            use_cache (bool): reuse results from the local geocode cache
+            refresh (bool): geocode every address again and overwrite the cached results
+            stream (bool): geocode and write the csv chunk by chunk, resuming an interrupted run
+            chunksize (int): rows per chunk when streaming
 
         Example: ../data/Mobile Sites Feb 19.csv
         
         To Do: Provide geocoded results such as 19/19 or 12/19 locations successfully geocoded 
         """
         
-        gis = self.connect_gis()    
-        
-        # uses world geocode server (most accurate)
-        geocoder = get_geocoders(gis)
+        if stream:
+            return self.stream_geocode_csv(csv_path, chunksize, max_workers, use_cache, refresh)
         
         file_name = csv_path.split("/")[-1]
-        df = pd.read_csv(csv_path)
-        addy = df.Address.to_list()
-        results = batch_geocode(addy, source_country="USA", geocoder=geocoder[1])
-        
-        location_df = pd.DataFrame()
-
-        for i in results:
-            results_json = pd.json_normalize(i['attributes'])
-            location_df = location_df.append(results_json)
-        
-        df = pd.merge(df,location_df[['ResultID','X','Y']],left_index=True,right_index=False, right_on='ResultID')
-
-        df.to_csv('output/csv/Geocoded '+ file_name, index=False)
+        with measure('read csv') as span:
+            df = pd.read_csv(csv_path)
+            span['rows'] = len(df)
+        results = self.geocode_addresses(df.Address.to_list(), max_workers, use_cache, refresh, address_keys(df))
+        df = self.attach_locations(df, results)
+
+        with measure('write csv', rows=len(df)):
+            df.to_csv('output/csv/Geocoded '+ file_name, index=False)
         print('Saved Geocoded Data To:','output/csv/Geocoded '+ file_name)
-        return
+        return 'output/csv/Geocoded '+ file_name
     
-    def geocode_df(self, df):
+    def stream_geocode_csv(self, csv_path: str, chunksize: int = STREAM_CHUNKSIZE,
+                           max_workers: int = DEFAULT_WORKERS,
+                           use_cache: bool = True, refresh: bool = False):
         """
-        Geocodes 'Address' column in a df and returns the same df with lat longs 
+        Geocodes a csv of any size chunk by chunk, appending each chunk to the output as soon as it is done
 
         Args:
-            df: df that you want to geocode
+            csv_path (str): path to csv that you want to geocode
+            chunksize (int): rows read, geocoded and written per step
+            max_workers (int): number of batches geocoded at the same time
+            use_cache (bool): reuse results from the local geocode cache
+            refresh (bool): geocode every address again and overwrite the cached results
 
-        Example: geocoded_df = gis.geocode_df(non_geocoded_df)
+        Example: ../data/County Addresses.csv
+        
+        A checkpoint next to the output records the hash of every committed chunk and the
+        output size after it, so rerunning after a crash skips straight to the first
+        uncommitted chunk. The checkpoint is removed once the whole file is done.
         """
         
-        gis = self.connect_gis()    
+        file_name = csv_path.split("/")[-1]
+        output_path = 'output/csv/Geocoded '+ file_name
+        checkpoint_path = output_path + '.checkpoint.json'
         
-        # uses world geocode server (most accurate)
-        geocoder = get_geocoders(gis)
+        checkpoint = load_json(checkpoint_path)
+        if (checkpoint is None or checkpoint['chunksize'] != chunksize
+                or not os.path.exists(output_path)):
+            checkpoint = {'input': csv_path, 'chunksize': chunksize, 'chunks': []}
+        elif checkpoint['chunks']:
+            print('Resuming after row', checkpoint['chunks'][-1]['rows'])
+        
+        committed = checkpoint['chunks']
+        number = -1
+        
+        with open(output_path, 'a+b') as output:
+            # drop anything written after the last committed chunk
+            output.truncate(committed[-1]['bytes'] if committed else 0)
+            
+            for number, chunk in enumerate(pd.read_csv(csv_path, chunksize=chunksize)):
+                chunk_hash = hashlib.sha1(pd.util.hash_pandas_object(chunk).values.tobytes()).hexdigest()
                 
-        addy = df.Address.to_list()
-        results = batch_geocode(addy, source_country="USA", geocoder=geocoder[1])
+                if number < len(committed):
+                    if committed[number]['hash'] == chunk_hash:
+                        continue
+                    
+                    # input changed under an old checkpoint, redo everything from this chunk on
+                    print('Input changed at row', chunk.index[0], 're-geocoding from there')
+                    del committed[number:]
+                    output.truncate(committed[-1]['bytes'] if committed else 0)
+                
+                rows = committed[-1]['rows'] if committed else 0
+                
+                results = self.geocode_addresses(chunk.Address.to_list(), max_workers, use_cache, refresh,
+                                                 address_keys(chunk))
+                chunk = self.attach_locations(chunk, results)
+                chunk['ResultID'] += rows
+                
+                with measure('write csv', rows=len(chunk)):
+                    output.seek(0, os.SEEK_END)
+                    output.write(chunk.to_csv(index=False, header=rows == 0).encode())
+                    output.flush()
+                    os.fsync(output.fileno())
+                
+                committed.append({'hash': chunk_hash, 'rows': rows + len(chunk), 'bytes': output.tell()})
+                save_json(checkpoint_path, checkpoint)
+                print('Geocoded rows:', rows + len(chunk))
+            
+            # input got shorter than the last run
+            if number + 1 < len(committed):
+                del committed[number + 1:]
+                output.truncate(committed[-1]['bytes'])
         
-        location_df = pd.DataFrame()
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        print('Saved Geocoded Data To:', output_path)
+        return output_path
+    
+    def geocode_df(self, df, max_workers: int = DEFAULT_WORKERS,
+                   use_cache: bool = True, refresh: bool = False):
+        """
+        Geocodes 'Address' column in a df and returns the same df with lat longs 
+
+        Args:
+            df: df that you want to geocode
+            max_workers (int): number of batches geocoded at the same time
+            use_cache (bool): reuse results from the local geocode cache
+            refresh (bool): geocode every address again and overwrite the cached results
 
-        for i in results:
-            results_json = pd.json_normalize(i['attributes'])
-            location_df = location_df.append(results_json)
+        Example: geocoded_df = gis.geocode_df(non_geocoded_df)
+        """
         
-        df = pd.merge(df,location_df[['ResultID','X','Y']],left_index=True,right_index=False, right_on='ResultID')
+        results = self.geocode_addresses(df.Address.to_list(), max_workers, use_cache, refresh, address_keys(df))
+        df = self.attach_locations(df, results)
 
         return df
     
-    def mass_geocode_df(self, df):
+    def mass_geocode_df(self, df, max_workers: int = DEFAULT_WORKERS,
+                        use_cache: bool = True, refresh: bool = False):
         """
         Geocodes 'Address' column in a df with more than 1000 addresses and returns the same df with lat longs 
 
         Args:
             df: df that you want to geocode
+            max_workers (int): number of batches geocoded at the same time
+            use_cache (bool): reuse results from the local geocode cache
+            refresh (bool): geocode every address again and overwrite the cached results
 
         Example: geocoded_df = gis.mass_geocode_df(non_geocoded_df)
+        
+        Kept for older scripts, geocode_df now splits large inputs into batches itself
         """
         
-        ngc_json = df.to_json(orient='records')
+        return self.geocode_df(df, max_workers, use_cache, refresh)
+    
+    def geocode_addresses(self, addresses: list, max_workers: int = DEFAULT_WORKERS,
+                          use_cache: bool = True, refresh: bool = False, keys: list = None):
+        """
+        Batch geocodes a list of addresses with the world geocoder
+
+        Args:
+            addresses (list): address strings
+            max_workers (int): number of batches geocoded at the same time
+            use_cache (bool): reuse results from the local geocode cache
+            refresh (bool): geocode every address again and overwrite the cached results
+            keys (list): canonical key per address, addresses sharing one are geocoded once
 
-        # read string as json
-        ngc_json = json.loads(ngc_json)
+        Example: results = gis.geocode_addresses(df.Address.to_list(), keys=address_keys(df))
         
-        gis = self.connect_gis()    
+        Returns raw batch_geocode results in the same order as addresses
+        """
         
         # uses world geocode server (most accurate)
-        geocoder = get_geocoders(gis)
+        geocoder = self.get_geocoders()
         
-        count = 0
-        for i in range(len(ngc_json)):
-            address = ngc_json[count]["Address"]
-            
-            # geocode
-            address_geocoded = geocode(address, source_country="USA", geocoder=geocoder[1])
-            
-            #string to json
-            address_json = json.dumps(address_geocoded)
-            
-            #load json
-            address_json = json.loads(address_json)
-            
-            #assign geocoded json to original dfjson
-            ngc_json[count]['location'] = address_json[0]['location']
-            
-            count += 1
-            print(count)
-            
-        gc_df = pd.json_normalize(ngc_json)
-                
-        return gc_df
+        cache = GeocodeCache() if use_cache else None
+        
+        try:
+            with measure('geocode', rows=len(addresses)):
+                return geocode_addresses(addresses, geocoder[1], source_country="USA", max_workers=max_workers,
+                                         cache=cache, refresh=refresh, keys=keys)
+        finally:
+            if cache is not None:
+                cache.close()
     
     
+    def attach_locations(self, df, results: list):
+        """
+        Adds ResultID, X and Y columns from ordered geocode results to df
+
+        Args:
+            df: df whose 'Address' column was geocoded
+            results (list): output of geocode_addresses for df.Address, in the same row order
+
+        Example: df = gis.attach_locations(df, gis.geocode_addresses(df.Address.to_list()))
+        
+        Columns df already has by those names, e.g. when a geocoded csv is geocoded again, are replaced
+        """
+        
+        with measure('merge', rows=len(df)):
+            location_df = results_to_frame(results)
+            location_df.index = df.index
+            
+            location_columns = ['ResultID','X','Y']
+            return df.drop(columns=location_columns, errors='ignore').join(location_df[location_columns])
+    
     def shp_zip(self, gdf,shp_dir,file_name):   
         try:
             gdf.to_file(shp_dir + "/" + file_name, driver = 'ESRI Shapefile')
@@ -174,15 +354,55 @@ class arcgis_api(object):
             
         shutil.make_archive(shp_dir + "/" + file_name, 'zip', shp_dir + "/" + file_name)
         
-    def upload_as_feature_layer(self, file_path: str):
+    def publish_geopackage(self, gdf, file_name: str):
         """
-        Uploads either a shapefile or csv with coordinates as a feature layer
+        Publishes a GeoDataFrame as a hosted feature layer through a single GeoPackage file
+
+        Args:
+            gdf: GeoDataFrame to publish
+            file_name (str): title of the new layer
+
+        example: gis.publish_geopackage(gpd.read_file("output/shp/Sites.shp"), "Sites")
+        
+        The GeoPackage is one temporary file, removed once published, no shapefile directory or zip is written
+        """
+        
+        gis = self.connect_gis()
+        
+        # a unique file per call, jobs publishing layers of the same name at once do not overwrite each other
+        handle, gpkg_path = tempfile.mkstemp(prefix=file_name + ' ', suffix='.gpkg')
+        os.close(handle)
+        
+        try:
+            gdf.to_file(gpkg_path, driver='GPKG', layer=file_name)
+            gpkg = request('content', gis.content.add, {'type':'GeoPackage','title':file_name}, gpkg_path,
+                           idempotent=False)
+            published_service = request('publish', gpkg.publish, idempotent=False)
+        finally:
+            os.remove(gpkg_path)
+        
+        item_properties = {"title":file_name,
+                           'description':'Vaccine Sites Carbon Health',
+                           "tags":"vaccine, i-team"}
+        
+        request('content', published_service.update, item_properties)
+        return published_service
+    
+    def upload_as_feature_layer(self, file_path: str, mode: str = None, key: str = 'Address',
+                                max_workers: int = EDIT_WORKERS):
+        """
+        Uploads a shapefile, GeoPackage, FlatGeobuf or csv with coordinates as a feature layer
 
         Args:
             file_path (str): path to file that you want to upload
+            mode (str): 'append' or 'upsert' a csv into the existing layer of the same name instead of publishing a new one
+            key (str): column identifying a row when appending or upserting
+            max_workers (int): edit batches sent at the same time when appending or upserting
 
         example: ../output/Geocoded Mobile Sites Feb 19.csv
                  ../output/Geocoded Mobile Sites Feb 19.shp
+                 ../output/Geocoded Mobile Sites Feb 19.gpkg
+                 ../output/Geocoded Mobile Sites Feb 19.fgb
         """
         
         gis = self.connect_gis()    
@@ -192,6 +412,12 @@ class arcgis_api(object):
         
         file_name = full_file_name[:-4]
         #file_type = file_name[-4:]
+        
+        if mode is not None and full_file_name.endswith('.csv'):
+            existing = find_layer(gis, file_name)
+            if existing is not None:
+                return self.update_feature_layer(existing, file_path, mode, key, max_workers)
+            print('No feature layer named', file_name, 'yet, publishing a new one')
        
         # makes feaure layer that is not hosted 
         # if full_file_name.endswith('.csv'):
@@ -218,8 +444,11 @@ class arcgis_api(object):
             #               "latitudeFieldName" : "Y",
             #               "longitudeFieldName" : 'X'}
             
-            df = pd.read_csv(file_path) 
-            feature_layer = gis.content.import_data(df,location_type='coordinates', latitude_field='Y', longitude_field='X')
+            with measure('read csv') as span:
+                df = pd.read_csv(file_path)
+                span['rows'] = len(df)
+            feature_layer = request('content', gis.content.import_data, df, location_type='coordinates',
+                                    latitude_field='Y', longitude_field='X', idempotent=False)
             feature_layer_dict = dict(feature_layer.properties)
             feature_layer_json = json.dumps({"featureCollection": {"layers": [feature_layer_dict]}})
             
@@ -231,301 +460,628 @@ class arcgis_api(object):
             
             #csv_item = gis.content.add(feature_layer_properties, csv_file)
             #csv_lyr = csv_item.publish(None, pub_params)
-            csv_item = gis.content.add(feature_layer_properties)
-            csv_lyr = csv_item.publish()
+            with measure('publish', rows=len(df)):
+                csv_item = request('content', gis.content.add, feature_layer_properties, idempotent=False)
+                csv_lyr = request('publish', csv_item.publish, idempotent=False)
             print(csv_lyr)
+            return csv_lyr
 
-        elif full_file_name.endswith('.shp'):
-            print('This file is a shapefile. still working on that')
+        elif full_file_name.endswith('.shp') or full_file_name.endswith('.fgb'):
+            # repacked as a single GeoPackage instead of a zipped shapefile directory
+            import geopandas as gpd
             gdf = gpd.read_file(file_path)
+            published_service = self.publish_geopackage(gdf, file_name)
+            print(published_service)
+            return published_service
+        
+        elif full_file_name.endswith('.gpkg'):
             
-            self.shp_zip(gdf,'output',file_name)
-            print('output' + "/" + file_name)
-            
-            shpfile = gis.content.add({}, 'output' + "/" + file_name)
-            published_service = shpfile.publish()
+            gpkg = request('content', gis.content.add, {'type':'GeoPackage','title':file_name}, file_path,
+                           idempotent=False)
+            published_service = request('publish', gpkg.publish, idempotent=False)
             
             item_properties = {"title":file_name,
                                'description':'Vaccine Sites Carbon Health',
                                "tags":"vaccine, i-team"}
             
-            published_service.update(item_properties)
+            request('content', published_service.update, item_properties)
             print(published_service)
+            return published_service
          
         elif full_file_name.endswith('.zip'):
 
-            shpfile = gis.content.add({}, file_path)
-            published_service = shpfile.publish()
+            shpfile = request('content', gis.content.add, {}, file_path, idempotent=False)
+            published_service = request('publish', shpfile.publish, idempotent=False)
             
             item_properties = {"title":file_name,
                                'description':'Vaccine Sites Carbon Health',
                                "tags":"vaccine, i-team"}
             
-            published_service.update(item_properties)
+            request('content', published_service.update, item_properties)
             print(published_service)
-        return 
+            return published_service
+
+    def update_feature_layer(self, item, csv_path: str, mode: str = 'upsert', key: str = 'Address',
+                             max_workers: int = EDIT_WORKERS):
+        """
+        Pushes only the rows of a csv that differ from a hosted feature layer
 
+        Args:
+            item: hosted feature layer item, e.g. from gis.content.get
+            csv_path (str): csv with the same columns the layer was published from
+            mode (str): 'append' only adds rows whose key is not in the layer yet (or is in it fewer
+                        times than in the csv), 'upsert' also updates changed rows and deletes rows
+                        missing from the csv
+            key (str): column identifying a row, e.g. 'Address' or 'ResultID'
+            max_workers (int): edit batches sent at the same time
+
+        example: gis.update_feature_layer(gis.connect_gis().content.get(item_id), "output/csv/Geocoded Mobile Sites.csv")
+        """
+        
+        layer = item.layers[0]
+        with measure('read csv') as span:
+            df = pd.read_csv(csv_path)
+            span['rows'] = len(df)
+        
+        xy = df[['X','Y']] if 'X' in df and 'Y' in df else None
+        names = field_names(df, layer)
+        df = df[list(names)].rename(columns=names)
+        
+        with measure('diff layer', rows=len(df)):
+            adds, updates, deletes = diff_layer(df, layer, names[key], max_workers)
+        if mode == 'append':
+            updates, deletes = updates.iloc[0:0], []
+        
+        wkid = layer.properties.extent.spatialReference.wkid
+        with measure('apply edits', rows=len(adds) + len(updates) + len(deletes)):
+            applied = apply_edits(layer, to_features(adds, xy, wkid),
+                                  to_features(updates, xy, wkid), deletes, max_workers=max_workers)
+        
+        print('Added', applied['adds'], 'of', len(adds), '| Updated', applied['updates'], 'of', len(updates),
+              '| Deleted', applied['deletes'], 'of', len(deletes), 'in', item.title)
+        return item
+    
     def prepend(self,list,str): 
             # Using format() 
             str += '{0}'
             list = [str.format(i) for i in list] 
             return(list) 
 
-    def enrich(self, feature_layer_name: str):
+    def enrich(self, feature_layer_name, refresh: bool = False,
+               distances: list = (3,), variable_sets: list = ('race_variables',)):
         """
         Takes a hosted feature layer and buffers the layer and apportions/enriches the newely created layer with ESRI variables 
 
         Args:
-            feature_layer_name (str): Name of hosted feature layer
+            feature_layer_name: Name of hosted feature layer, or the layer item itself (e.g. from upload_as_feature_layer)
+            refresh (bool): run the enrichment even if the same features were enriched before
+            distances (list): buffer distances in miles, one enrichment job per distance and variable set
+            variable_sets (list): names of variable lists in data/enrichment_variables
 
         example: "Geocoded Mobile Sites Mar 1"
         
-        todo
-        append data automatically
+        Jobs are cached by a hash of the layer's features, the variables and the buffer, so
+        enriching unchanged data again returns the layer made the first time.
+        
+        With more than one distance or variable set the jobs run at the same time and their
+        results are merged into output/csv/Enriched <name>.csv, one row per site with the
+        variables of each ring suffixed by its distance (e.g. WHTM65_CY_3mi).
         """
         
-        gis = self.connect_gis()    
+        items = self.enrich_jobs(feature_layer_name, refresh, distances, variable_sets)
         
-        search_result = gis.content.search('title:' + feature_layer_name, item_type='Feature Layer')
-        feature_layer = gis.content.get(search_result[0].id)
+        if len(items) == 1:
+            return list(items.values())[0]
         
-        # grab first feature layer from feature layer collection 
-        layer = FeatureLayer(feature_layer.layers[0].url)
-        
-        usa = Country.get('US')
+        if not isinstance(feature_layer_name, str):
+            feature_layer_name = feature_layer_name.title
         
-        datasets = usa.data_collections
-
-        # get all the unique data collections available
-        topics = datasets.index.unique()
-
-        with open ('data/enrichment_variables/race_variables.txt', 'rb') as fp:
-            race_variables = pickle.load(fp)
+        with measure('merge'):
+            enriched = self._merge_enriched(items)
+        output_path = 'output/csv/Enriched ' + feature_layer_name + '.csv'
+        with measure('write csv', rows=len(enriched)):
+            enriched.to_csv(output_path, index=False)
+        print('Saved Merged Enrichment To:', output_path)
+        return enriched
     
-        race_variables = self.prepend(race_variables, 'agebyracebysex.') 
-        
-        race_layer_name = 'Age and Race by Sex 3 Mile Buffer ' + feature_layer_name 
-        print('Enriching Data...Please Wait')
-        race_buffer = enrich_data.enrich_layer(layer, country='US', analysis_variables=race_variables, buffer_type='StraightLine', distance=3, units='Miles', output_name=race_layer_name)
-        print('Newely Created Layer ID is:',race_buffer.id)
-
-    def download_feature_layer(self, feature_layer_id: str):
+    def enrich_jobs(self, feature_layer, refresh: bool = False,
+                    distances: list = (3,), variable_sets: list = ('race_variables',)):
         """
-        Downloads a feature layer 
+        Runs one enrichment job per variable set and distance at the same time
 
         Args:
-            feature_layer_id (str): ID of hosted feature layer
+            feature_layer: Name of hosted feature layer, or the layer item itself
 
-        example: "6a57ff95150f404d884bd782f690d7e6"
-        
-        todo:
-        add flag for shapefile
+        Returns {(variable_set, distance): enriched layer item}
         """
         
+        from arcgis.features import FeatureLayer
+        
         gis = self.connect_gis()    
         
-        # pull content from layer
-        feature_layer = gis.content.get(feature_layer_id)
-
-        print('Feature Layers Associated',feature_layer.layers)
-
+        if isinstance(feature_layer, str):
+            search_result = request('content', gis.content.search, 'title:' + feature_layer, item_type='Feature Layer')
+            feature_layer = request('content', gis.content.get, search_result[0].id)
+        feature_layer_name = feature_layer.title
+        
         # grab first feature layer from feature layer collection 
         layer = FeatureLayer(feature_layer.layers[0].url)
-        layer_name = feature_layer.layers[0].properties.name
-
-        # print layer capabilities
-        layer.properties.capabilities
-
-        df = pd.DataFrame((layer.query(out_fields='*', where='1=1', as_df=True, return_geometry=False)))
-        df.to_csv('output/csv/'+layer_name+'.csv', index=False)
-        print('Data saved to '+'output/csv.'+layer_name+'.csv')
-
-    def print_breakdown(self, file_path: str):
+        with measure('query features') as span:
+            features = request('query', layer.query, where='1=1', out_fields='*').to_dict()['features']
+            span['rows'] = len(features)
+        
+        jobs = [(variable_set, distance) for variable_set in variable_sets for distance in distances]
+        
+        with measure('enrich', rows=len(features) * len(jobs)), ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            futures = {pool.submit(self._enrich_job, layer, features, feature_layer_name,
+                                   variable_set, distance, refresh): (variable_set, distance)
+                       for variable_set, distance in jobs}
+            
+            # report each job as soon as it is done, total wait is the slowest job
+            items = {}
+            for future in as_completed(futures):
+                items[futures[future]] = future.result()
+        
+        return items
+    
+    def _enrich_job(self, layer, features: list, feature_layer_name: str, variable_set: str,
+                    distance: float, refresh: bool):
+        from arcgis.features import enrich_data
+        from .local_enrich import load_variable_set, variable_set_title
+        
+        gis = self.connect_gis()
+        
+        variables = load_variable_set(variable_set)
+        buffer = {'buffer_type': 'StraightLine', 'distance': distance, 'units': 'Miles'}
+        
+        job_key = fingerprint(features, variables, buffer)
+        
+        cache = EnrichCache()
+        cached = cache.get(job_key)
+        if cached is not None and not refresh:
+            enriched_layer = request('content', gis.content.get, cached['item_id'])
+            if enriched_layer is not None:
+                print('Same data was already enriched, Layer ID is:',enriched_layer.id)
+                return enriched_layer
+            # the layer was deleted since, enrich again. Reload, other jobs may have written the index
+            with self._session_lock:
+                EnrichCache().drop(job_key)
+        
+        # arcgis refuses output names in use and the layer of an earlier job keeps its name, so every
+        # job is stamped with when it ran. The stamp goes before the layer title so the reporting
+        # date stays at the end of the name for the breakdown
+        layer_name = '%s %g Mile Buffer %s %s' % (variable_set_title(variable_set), distance,
+                                                  time.strftime('%Y%m%d%H%M%S'), feature_layer_name)
+        print('Enriching Data...Please Wait:', layer_name)
+        enriched_layer = request('enrich', enrich_data.enrich_layer, layer, country='US', analysis_variables=variables,
+                                 output_name=layer_name, idempotent=False, **buffer)
+        print('Newely Created Layer ID is:',enriched_layer.id, layer_name)
+        
+        # reload, other jobs may have finished and written the index in the meantime
+        with self._session_lock:
+            EnrichCache().put(job_key, item_id=enriched_layer.id, output_name=layer_name)
+        return enriched_layer
+    
+    def _merge_enriched(self, items: dict, site_key: str = 'ID'):
+        """
+        Joins the tables of several enrich jobs side by side, one row per site
+        """
+        from arcgis.features import FeatureLayer
+        from .local_enrich import load_variable_set
+        
+        enriched = None
+        
+        for (variable_set, distance), item in sorted(items.items(), key=lambda job: (job[0][0], job[0][1])):
+            pages = list(iter_pages(FeatureLayer(item.layers[0].url), out_fields='*', return_geometry=False))
+            table = pd.concat(pages, ignore_index=True)
+            
+            variables = [variable.split('.')[-1] for variable in load_variable_set(variable_set)]
+            ring = table[[site_key] + variables].rename(columns={variable: '%s_%gmi' % (variable, distance)
+                                                                 for variable in variables})
+            
+            if enriched is None:
+                # site attributes come from the first ring, the buffer specific columns do not carry over
+                enriched = table.drop(columns=variables + ['OBJECTID', 'ENRICH_FID', 'bufferRadii', 'HasData',
+                                                       'populationToPolygonSizeRating', 'apportionmentConfidence'],
+                                      errors='ignore')
+            enriched = enriched.merge(ring, on=site_key, how='outer')
+        
+        return enriched
+    
+    def enrichment_catalog(self, refresh: bool = False):
         """
-        Prints race age breakdown 
+        Returns the US GeoEnrichment data collections (variables available to enrich), cached on disk
 
         Args:
-            file_path (str): Path to csv output for race age breakdown
+            refresh (bool): download the catalog again even if the cached copy is recent
 
-        example: "output/Age and Race by Sex 3 Mile Buffer Mar 1.csv"
+        example: catalog = gis.enrichment_catalog(); catalog.loc['agebyracebysex']
         """
         
-        df = pd.read_csv(file_path)
-        ## White
-        print('Total White Pop:',sum(df['WAGEBASECY']))
-        print('Total White Male Pop:',sum(df['WHTMBASECY']))
-
-        df['WM65-74'] = df.WHTM65_CY + df.WHTM70_CY
-        print('Total White Males 65-74:',sum(df['WM65-74']))
-
-        df['WM75-84'] = df.WHTM75_CY + df.WHTM80_CY
-        print('Total White Males 75-84:',sum(df['WM75-84']))
-
-        print('Total White Males 85+:',sum(df['WHTM85_CY']))
-
-        print('Total White Female Pop:',sum(df['WHTFBASECY']))
-
-
-        df['WF65-74'] = df.WHTF65_CY + df.WHTF70_CY
-        print('Total White Females 65-74:',sum(df['WF65-74']))
-
-        df['WF75-84'] = df.WHTF75_CY + df.WHTF80_CY
-        print('Total White Females 75-84:',sum(df['WF75-84']))
-
-        print('Total White Females 85+:',sum(df['WHTF85_CY']))
-
-
-        input('Press Any Key To Continue')
-        ## Black
-
-        print('Total Black Pop:',sum(df['WAGEBASECY']))
-        print('Total Black Male Pop:',sum(df['BLKMBASECY']))
-
-        df['BLKM65-74'] = df.BLKM65_CY + df.BLKM70_CY
-        print('Total Black Males 65-74:',sum(df['BLKM65-74']))
-
-        df['BLKM75-84'] = df.BLKM75_CY + df.BLKM80_CY
-        print('Total Black Males 75-84:',sum(df['BLKM75-84']))
-
-        print('Total Black Males 85+:',sum(df['BLKM85_CY']))
-
-
-        print('Total Black Female Pop:',sum(df['BLKFBASECY']))
-
-        df['BLKF65-74'] = df.BLKF65_CY + df.BLKF70_CY
-        print('Total Black Females 65-74:',sum(df['BLKF65-74']))
-
-        df['BLKF75-84'] = df.BLKF75_CY + df.BLKF80_CY
-        print('Total Black Females 75-84:',sum(df['BLKF75-84']))
-
-        print('Total Black Females 85+:',sum(df['BLKF85_CY']))
-
-        input('Press Any Key To Continue')
-
-        ## Native American
-
-        print('Total Native American Pop:',sum(df['IAGEBASECY']))
-
-        print('Total Native American Male Pop:',sum(df['AIMBASE_CY']))
-
-        df['AIM65-74'] = df.AIM65_CY + df.AIM70_CY
-        print('Total Native American Males 65-74:',sum(df['AIM65-74']))
-
-        df['AIM75-84'] = df.AIM75_CY + df.AIM80_CY
-        print('Total Native American Males 75-84:',sum(df['AIM75-84']))
-
-        print('Total Native American Males 85+:',sum(df['AIM85_CY']))
-
-        print('Total Native American Female Pop:',sum(df['AIFBASE_CY']))
-
-        df['AIF65-74'] = df.AIF65_CY + df.AIF70_CY
-        print('Total Native American Females 65-74:',sum(df['AIF65-74']))
-
-        df['AIF75-84'] = df.AIF75_CY + df.AIF80_CY
-        print('Total Native American Females 75-84:',sum(df['AIF75-84']))
-
-        print('Total Native American Females 85+:',sum(df['AIF85_CY']))
-
-        input('Press Any Key To Continue')
-
-        ## Asian
-
-        print('Total Asian Pop:',sum(df['AAGEBASECY']))
-
-        print('Total Asian Male Pop:',sum(df['ASNMBASECY']))
-
-        df['ASNM65-74'] = df.ASNM65_CY + df.ASNM70_CY
-        print('Total Asian Males 65-74:',sum(df['ASNM65-74']))
-
-        df['ASNM75-84'] = df.ASNM75_CY + df.ASNM80_CY
-        print('Total Asian Males 75-84:',sum(df['ASNM75-84']))
-
-        print('Total Asian Males 85+:',sum(df['ASNM85_CY']))
-
-        print('Total Asian Female Pop:',sum(df['ASNFBASECY']))
-
-        df['ASNF65-74'] = df.ASNF65_CY + df.ASNF70_CY
-        print('Total Asian Females 65-74:',sum(df['ASNF65-74']))
-
-        df['ASNF75-84'] = df.ASNF75_CY + df.ASNF80_CY
-        print('Total Asian Females 75-84:',sum(df['ASNF75-84']))
-
-        print('Total Asian Females 85+:',sum(df['ASNF85_CY']))
-
-        input('Press Any Key To Continue')
-
-        ## Pacific Islander
-
-        print('Total Pacific Islander Pop:',sum(df['PAGEBASECY']))
-
-        print('Total Pacific Islander Male Pop:',sum(df['PIMBASE_CY']))
-        df['PIM65-74'] = df.PIM65_CY + df.PIM70_CY
-        print('Total Pacific Islander Males 65-74:',sum(df['PIM65-74']))
-
-        df['PIM75-84'] = df.PIM75_CY + df.PIM80_CY
-        print('Total Pacific Islander Males 75-84:',sum(df['PIM75-84']))
-
-        print('Total Pacific Islander Males 85+:',sum(df['PIM85_CY']))
+        if not refresh and os.path.exists(CATALOG_PATH) and time.time() - os.path.getmtime(CATALOG_PATH) < CATALOG_TTL:
+            return pd.read_pickle(CATALOG_PATH)
+        
+        from arcgis.geoenrichment import Country
+        
+        self.connect_gis()
+        catalog = request('content', Country.get, 'US').data_collections
+        
+        os.makedirs(os.path.dirname(CATALOG_PATH), exist_ok=True)
+        catalog.to_pickle(CATALOG_PATH)
+        return catalog
 
-        print('Total Pacific Islander Female Pop:',sum(df['PIFBASE_CY']))
+    def local_enrich(self, sites_path: str, block_groups_path: str, demographics_path: str = None,
+                     radii: list = (3,), key: str = 'GEOID'):
+        """
+        Buffers geocoded sites and apportions block group demographics into them locally, an offline
+        alternative to enrich for trying out many radii
 
-        df['PIF65-74'] = df.PIF65_CY + df.PIF70_CY
-        print('Total Pacific Islander Females 65-74:',sum(df['PIF65-74']))
+        Args:
+            sites_path (str): geocoded csv with X and Y columns
+            block_groups_path (str): shapefile or GeoPackage of block groups
+            demographics_path (str): csv of the race variables per block group, joined on key
+            radii (list): buffer distances in miles, one output csv per radius
+            key (str): block group id column
+
+        example: gis.local_enrich("output/csv/Geocoded Mobile Sites.csv", "data/shp/block_groups.gpkg",
+                                  "data/csv/block_group_race.csv", radii=[1, 3, 5])
+        
+        Counts are apportioned by area share, so they are estimates. Use enrich for final numbers.
+        """
+        
+        from .local_enrich import enrich_sites, load_block_groups, load_variables
+        from .spatial import read_points
+        
+        with measure('read') as span:
+            sites = read_points(sites_path)
+            block_groups = load_block_groups(block_groups_path, demographics_path, key)
+            span['rows'] = len(sites) + len(block_groups)
+        
+        with measure('apportion', rows=len(sites) * len(radii)):
+            enriched = enrich_sites(sites, block_groups, radii, load_variables())
+        
+        file_name = sites_path.split("/")[-1][:-4]
+        for radius, table in enriched.items():
+            output_path = 'output/csv/Local Age and Race by Sex %g Mile Buffer %s.csv' % (radius, file_name)
+            with measure('write csv', rows=len(table)):
+                table.to_csv(output_path, index=False)
+            print('Saved Enriched Data To:', output_path)
+        
+        return enriched
 
-        df['PIF75-84'] = df.PIF75_CY + df.PIF80_CY
-        print('Total Pacific Islander Females 75-84:',sum(df['PIF75-84']))
+    def coverage(self, sites_path: str, block_groups_path: str, demographics_path: str = None,
+                 radii: list = (3,), key: str = 'GEOID'):
+        """
+        Population covered by overlapping site buffers without double counting, plus what each site adds
 
-        print('Total Pacific Islander Females 85+:',sum(df['PIF85_CY']))
+        Args:
+            sites_path (str): geocoded csv with X and Y columns, existing or candidate sites
+            block_groups_path (str): shapefile or GeoPackage of block groups
+            demographics_path (str): csv of the race variables per block group, joined on key
+            radii (list): buffer distances in miles, one set of outputs per radius
+            key (str): block group id column
+
+        example: gis.coverage("output/csv/Geocoded Mobile Sites.csv", "data/shp/block_groups.gpkg",
+                              "data/csv/block_group_race.csv", radii=[3])
+
+        Per radius it writes 'Coverage <radius> Mile Buffer <file>.csv' with each site's
+        exclusive and shared area and the counts only that site covers, and 'Coverage Union
+        <radius> Mile Buffer <file>.csv' with the counts of the dissolved buffers. Both have the
+        enrich output's race variable columns, so -rb works on them. Counts are area based estimates.
+        """
 
-        input('Press Any Key To Continue')
+        from .coverage import cover_sites
+        from .local_enrich import load_block_groups, load_variables
+        from .spatial import read_points
 
-        ## Other
-        print('Total Other Race Pop:',sum(df['OAGEBASECY']))
+        with measure('read') as span:
+            sites = read_points(sites_path)
+            block_groups = load_block_groups(block_groups_path, demographics_path, key)
+            span['rows'] = len(sites) + len(block_groups)
 
-        print('Total Other Race Male Pop:',sum(df['OTHMBASECY']))
+        with measure('coverage', rows=len(sites) * len(radii)):
+            covered = cover_sites(sites, block_groups, radii, load_variables())
 
-        df['OTHM65-74'] = df.OTHM65_CY + df.OTHM70_CY
-        print('Total Other Race Males 65-74:',sum(df['OTHM65-74']))
+        file_name = sites_path.split("/")[-1][:-4]
+        for radius, (table, total, summed) in covered.items():
+            site_path = 'output/csv/Coverage %g Mile Buffer %s.csv' % (radius, file_name)
+            union_path = 'output/csv/Coverage Union %g Mile Buffer %s.csv' % (radius, file_name)
+            with measure('write csv', rows=len(table) + 1):
+                table.to_csv(site_path, index=False)
+                total.to_csv(union_path, index=False)
 
-        df['OTHM75-84'] = df.OTHM75_CY + df.OTHM80_CY
-        print('Total Other Race Males 75-84:',sum(df['OTHM75-84']))
+            self._print_coverage(radius, table, total, summed)
+            print('Saved Coverage Data To:', site_path, 'and', union_path)
 
-        print('Total Other Race Males 85+:',sum(df['OTHM85_CY']))
+        return covered
 
-        print('Total Other Race Female Pop:',sum(df['OTHFBASECY']))
+    def _print_coverage(self, radius: float, coverage, total, summed):
+        """
+        Per race totals of the buffers added up next to the deduplicated totals of their union
+        """
 
-        df['OTHF65-74'] = df.OTHF65_CY + df.OTHF70_CY
-        print('Total Other Race Females 65-74:',sum(df['OTHF65-74']))
+        deduplicated = breakdown_table(total)
+        deduplicated['buffers_summed'] = breakdown_table(summed)['population']
+        deduplicated = deduplicated[(deduplicated.sex == 'All') & (deduplicated.age == 'All')]
+        deduplicated['double_counted'] = deduplicated.buffers_summed - deduplicated.population
 
-        df['OTHF75-84'] = df.OTHF75_CY + df.OTHF80_CY
-        print('Total Other Race Females 75-84:',sum(df['OTHF75-84']))
+        print('%g mile buffers: %.1f sq miles covered, %.1f summed, %d of %d sites overlap another'
+              % (radius, total.sq_miles[0], summed.sq_miles[0], (coverage.overlapping_sites > 0).sum(), len(coverage)))
+        print(deduplicated[['race', 'buffers_summed', 'population', 'double_counted']].round(0)
+              .to_string(index=False))
 
-        print('Total Other Race Females 85+:',sum(df['OTHF85_CY']))
+    def download_feature_layer(self, feature_layer_id: str, max_workers: int = DOWNLOAD_WORKERS,
+                               sync: bool = False, since: str = None, output_format: str = 'csv'):
+        """
+        Downloads a feature layer page by page, pages are sized to the layer's maxRecordCount
 
-        input('Press Any Key To Continue')
+        Args:
+            feature_layer_id (str): ID of hosted feature layer
+            max_workers (int): number of pages downloaded at the same time
+            sync (bool): only fetch rows changed since the last download and merge them into the existing csv
+            since (str): with sync, fetch rows edited after this date instead of the last sync, e.g. "2021-03-15",
+                         or rows after this OBJECTID when the layer has no editor tracking
+            output_format (str): 'csv' or 'parquet' (compact dtypes, needs pyarrow). Sync always uses csv
 
-        ## Hispanic
+        example: "6a57ff95150f404d884bd782f690d7e6"
+        
+        Only attributes are downloaded, use download_feature_layer_geometry for shapes
+        """
+        from arcgis.features import FeatureLayer
+        
+        if output_format not in ('csv', 'parquet'):
+            raise ValueError('Downloads are written as csv or parquet, not %s' % output_format)
+        
+        gis = self.connect_gis()    
+        
+        # pull content from layer
+        feature_layer = request('content', gis.content.get, feature_layer_id)
 
-        print('Total Hispanic Pop:',sum(df['HAGEBASECY']))
+        print('Feature Layers Associated',feature_layer.layers)
 
-        print('Total Hispanic Male Pop:',sum(df['HSPMBASECY']))
+        # grab first feature layer from feature layer collection 
+        layer = FeatureLayer(feature_layer.layers[0].url)
+        layer_name = feature_layer.layers[0].properties.name
 
-        df['HSPM65-74'] = df.HSPM65_CY + df.HSPM70_CY
-        print('Total Hispanic Males 65-74:',sum(df['HSPM65-74']))
+        # print layer capabilities
+        layer.properties.capabilities
 
-        df['HSPM75-84'] = df.HSPM75_CY + df.HSPM80_CY
-        print('Total Hispanic Males 75-84:',sum(df['HSPM75-84']))
+        if sync or since is not None:
+            with measure('sync') as span:
+                changed, deleted = sync_csv(layer, 'output/csv/'+layer_name+'.csv',
+                                            CACHE_DIR + '/sync/' + feature_layer_id + '.json', since=since,
+                                            max_workers=max_workers, out_fields='*', return_geometry=False)
+                span['rows'] = changed
+            print(changed, 'rows changed and', deleted, 'rows deleted in '+'output/csv/'+layer_name+'.csv')
+            return 'output/csv/'+layer_name+'.csv'
+        
+        if output_format == 'parquet':
+            with measure('download') as span:
+                rows = span['rows'] = download_parquet(layer, 'output/'+layer_name+'.parquet', where='1=1',
+                                                       max_workers=max_workers, out_fields='*', return_geometry=False)
+            print(rows, 'rows saved to '+'output/'+layer_name+'.parquet')
+            return 'output/'+layer_name+'.parquet'
+        
+        with measure('download') as span:
+            rows = span['rows'] = download_csv(layer, 'output/csv/'+layer_name+'.csv', where='1=1',
+                                               max_workers=max_workers, out_fields='*', return_geometry=False)
+        print(rows, 'rows saved to '+'output/csv/'+layer_name+'.csv')
+        return 'output/csv/'+layer_name+'.csv'
+
+    def download_feature_layer_geometry(self, feature_layer_id: str, output_format: str = 'gpkg',
+                                        max_workers: int = DOWNLOAD_WORKERS, out_sr: int = None,
+                                        max_allowable_offset: float = None, geometry_precision: int = None,
+                                        quantize: float = None):
+        """
+        Downloads a feature layer with its geometry straight into a spatial file in output/shp
 
-        print('Total Hispanic Males 85+:',sum(df['HSPM85_CY']))
+        Args:
+            feature_layer_id (str): ID of hosted feature layer
+            output_format (str): 'gpkg', 'fgb' (FlatGeobuf) or 'parquet' (GeoParquet)
+            max_workers (int): number of pages downloaded at the same time
+            out_sr (int): wkid to project to on the server, e.g. 4326
+            max_allowable_offset (float): let the server generalize shapes by up to this distance (output crs units)
+            geometry_precision (int): decimal places kept in coordinates
+            quantize (float): let the server snap vertices to a grid of this size (layer crs units)
+
+        example: gis.download_feature_layer_geometry("6a57ff95150f404d884bd782f690d7e6", out_sr=4326, geometry_precision=5)
+        
+        For zipcode polygons at map scale, generalizing or quantizing to a few meters cuts the
+        download and parse time several times over.
+        """
+        from arcgis.features import FeatureLayer
+        
+        drivers = {'gpkg': 'GPKG', 'fgb': 'FlatGeobuf', 'parquet': 'Parquet'}
+        if output_format not in drivers:
+            raise ValueError('Geometry downloads are written as %s, not %s' % (', '.join(drivers), output_format))
+        driver = drivers[output_format]
+        
+        gis = self.connect_gis()    
+        
+        feature_layer = request('content', gis.content.get, feature_layer_id)
+        layer = FeatureLayer(feature_layer.layers[0].url)
+        layer_name = feature_layer.layers[0].properties.name
+        
+        output_path = 'output/shp/' + layer_name + '.' + output_format
+        
+        with measure('download') as span:
+            rows = span['rows'] = download_geodata(layer, output_path, driver, max_workers=max_workers, out_sr=out_sr,
+                                                   max_allowable_offset=max_allowable_offset,
+                                                   geometry_precision=geometry_precision, quantize=quantize)
+        print(rows, 'features saved to', output_path)
+        return output_path
+    
+    def spatial_join(self, points_path: str, polygons_path: str, radius: float = None):
+        """
+        Joins geocoded points to polygons locally, no arcgis online round trip
 
-        print('Total Hispanic Female Pop:',sum(df['HSPFBASECY']))
+        Args:
+            points_path (str): geocoded csv with X and Y columns
+            polygons_path (str): shapefile or GeoPackage of polygons, e.g. zipcodes in data/shp
+            radius (float): instead of the polygon each point is in, list every polygon within this many miles
 
-        df['HSPF65-74'] = df.HSPF65_CY + df.HSPF70_CY
-        print('Total Hispanic Females 65-74:',sum(df['HSPF65-74']))
+        example: gis.spatial_join("output/csv/Geocoded Mobile Sites.csv", "data/shp/zipcodes.gpkg")
+        """
+        
+        from .spatial import join_points_to_polygons, read_points, read_polygons, within_radius
+        
+        with measure('read') as span:
+            points = read_points(points_path)
+            polygons = read_polygons(polygons_path)
+            span['rows'] = len(points) + len(polygons)
+        
+        with measure('join', rows=len(points)):
+            if radius is None:
+                joined = pd.DataFrame(join_points_to_polygons(points, polygons).drop(columns='geometry'))
+            else:
+                pairs = within_radius(points, polygons, radius)
+                point_columns = pd.DataFrame(points.drop(columns='geometry')).iloc[pairs.point_index].reset_index(drop=True)
+                polygon_columns = pd.DataFrame(polygons.drop(columns=polygons.geometry.name)).iloc[pairs.target_index].reset_index(drop=True)
+                joined = point_columns.join(polygon_columns, rsuffix='_polygon')
+                joined['distance_miles'] = pairs.distance_miles.to_numpy()
+        
+        output_path = 'output/csv/Joined ' + points_path.split("/")[-1]
+        with measure('write csv', rows=len(joined)):
+            joined.to_csv(output_path, index=False)
+        print('Saved Joined Data To:', output_path)
+        return joined
+    
+    def print_breakdown(self, file_path: str, per_site: bool = False, output_format: str = 'csv',
+                        max_workers: int = None):
+        """
+        Prints race age breakdown and saves it as a table in the output folder
 
-        df['HSPF75-84'] = df.HSPF75_CY + df.HSPF80_CY
-        print('Total Hispanic Females 75-84:',sum(df['HSPF75-84']))
+        Args:
+            file_path (str): Path to csv output for race age breakdown, or a directory / glob of them
+            per_site (bool): break down every site (OBJECTID) instead of only the grand totals, the
+                             totals are still what is printed
+            output_format (str): 'csv' or 'json'
+            max_workers (int): worker processes used for a directory or glob, defaults to the number of cores
 
-        print('Total Hispanic Females 85+:',sum(df['HSPF85_CY']))
+        example: "output/Age and Race by Sex 3 Mile Buffer Mar 1.csv"
+                 "output/csv/Age and Race by Sex 3 Mile Buffer*.csv"
+        """
+        
+        if output_format not in ('csv', 'json'):
+            raise ValueError('Breakdowns are written as csv or json, not %s' % output_format)
+        
+        if os.path.isdir(file_path) or glob.has_magic(file_path):
+            file_paths = breakdown_inputs(file_path, per_site)
+            if not file_paths:
+                raise ValueError('No enriched csvs to break down in ' + file_path)
+            
+            with measure('breakdown') as span:
+                table = breakdown_files(file_paths, per_site=per_site, max_workers=max_workers)
+                span['rows'] = len(table)
+            
+            # one column per reporting period for the headline numbers, or per file when names carry no
+            # date or files share one (e.g. 3 and 5 mile buffers of Mar 15), files are never added up
+            totals = table[(table.sex == 'All') & (table.age == 'All')]
+            dates = totals.drop_duplicates('file').date
+            period = 'date' if dates.notna().all() and dates.is_unique else 'file'
+            print(totals.pivot_table(index='race', columns=period, values='population', aggfunc='sum', sort=False).to_string())
+            print(len(file_paths), 'files broken down')
+            
+            output_name = OUTPUT_PREFIX + 'Series'
+        else:
+            with measure('breakdown') as span:
+                table = breakdown_file(file_path, per_site=per_site).drop(columns=['file', 'date'])
+                span['rows'] = len(table)
+            # per site tables run to thousands of rows, only their totals are printed and every site is in the file
+            printed = table
+            if per_site:
+                printed = table.groupby(['race', 'sex', 'age'], sort=False, as_index=False).population.sum()
+            with measure('print', rows=len(printed)):
+                print(printed.to_string(index=False))
+                if per_site:
+                    print('Totals of', table[SITE_COLUMN].nunique(), 'sites, the saved table has every site')
+            
+            output_name = OUTPUT_PREFIX + file_path.split("/")[-1][:-4]
+        
+        output_path = 'output/csv/' + output_name + '.' + output_format
+        
+        with measure('write ' + output_format, rows=len(table)):
+            if output_format == 'json':
+                table.to_json(output_path, orient='records', indent=2)
+            else:
+                table.to_csv(output_path, index=False)
+        
+        print('Saved Breakdown To:', output_path)
+        return table
+    
+    def pipeline(self, csv_path: str, refresh: bool = False, distances: list = (3,),
+                 variable_sets: list = ('race_variables',), key: str = 'Address', per_site: bool = False,
+                 output_format: str = 'csv', max_workers: int = None, stream: bool = False):
+        """
+        Runs the suggested workflow (geocode, upload, enrich, download, breakdown) on a csv in one session
 
-        input('Press Any Key To Continue')
\ No newline at end of file
+        Args:
+            csv_path (str): csv of addresses, as for geocode_csv
+            refresh (bool): run every stage again even if its inputs did not change
+            distances (list): buffer distances in miles for enrich
+            variable_sets (list): names of variable lists in data/enrichment_variables
+            key (str): column identifying a row when the uploaded layer is updated on a rerun
+            per_site (bool): break down every site instead of only the totals
+            output_format (str): 'csv' or 'json' for the breakdowns
+            max_workers (int): geocode batches, edit batches and download pages processed at the same time
+            stream (bool): geocode chunk by chunk, so a crash part way through geocoding resumes too
+
+        example: gis.pipeline("data/Mobile Sites Mar 1.csv", distances=[1, 3])
+        
+        Item IDs are handed from stage to stage. What each stage produced is kept in
+        output/cache/pipeline/<csv name>.json with a fingerprint of its inputs, so stages whose
+        inputs are unchanged are skipped and a failed run picks up at the stage that failed.
+        When the geocoded csv changes, the layer uploaded before (or a layer of the same name) is
+        upserted instead of published again. It is then enriched into new layers, whose names are
+        stamped with when they ran (see _enrich_job), next to the layers of the earlier run.
+        """
+        
+        if output_format not in ('csv', 'json'):
+            raise ValueError('Breakdowns are written as csv or json, not %s' % output_format)
+        
+        gis = self.connect_gis()
+        state = PipelineState(state_path(csv_path))
+        workers = {} if max_workers is None else {'max_workers': max_workers}
+        
+        def items_exist(item_ids):
+            return all(request('content', gis.content.get, item_id) is not None for item_id in item_ids)
+        
+        geocoded_path = state.run('geocode', [file_fingerprint(csv_path), csv_path],
+                                  lambda: self.geocode_csv(csv_path, **workers, refresh=refresh, stream=stream),
+                                  valid=os.path.exists, refresh=refresh)
+        
+        def upload():
+            previous = state.get('upload')
+            item = request('content', gis.content.get, previous) if previous is not None else None
+            if item is not None:
+                return self.update_feature_layer(item, geocoded_path, 'upsert', key, **workers).id
+            # a layer of the same name, e.g. from a run whose state file is gone, is upserted rather than clashed with
+            return self.upload_as_feature_layer(geocoded_path, mode='upsert', key=key, **workers).id
+        
+        item_id = state.run('upload', [file_fingerprint(geocoded_path), key], upload,
+                            valid=lambda item_id: items_exist([item_id]), refresh=refresh)
+        
+        def enrich():
+            items = self.enrich_jobs(request('content', gis.content.get, item_id), refresh, distances, variable_sets)
+            return [items[job].id for job in sorted(items)]
+        
+        enriched_ids = state.run('enrich', [item_id, file_fingerprint(geocoded_path), list(distances),
+                                            list(variable_sets)],
+                                 enrich, valid=items_exist, refresh=refresh)
+        
+        downloaded_paths = state.run('download', enriched_ids,
+                                     lambda: [self.download_feature_layer(enriched_id, **workers)
+                                              for enriched_id in enriched_ids],
+                                     valid=lambda paths: all(os.path.exists(path) for path in paths),
+                                     refresh=refresh)
+        
+        def breakdown():
+            for path in downloaded_paths:
+                self.print_breakdown(path, per_site=per_site, output_format=output_format)
+            return downloaded_paths
+        
+        state.run('breakdown', [[file_fingerprint(path) for path in downloaded_paths], per_site, output_format],
+                  breakdown, refresh=refresh)
+        
+        print('Pipeline finished for', csv_path)
+        return downloaded_paths
@@ -0,0 +1,171 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from .address import normalize_addresses
+from .scheduler import request
+
+# fallback used when the geocoder does not report its own batch limit
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_WORKERS = 4
+
+
+def max_batch_size(geocoder):
+    """
+    Reads the largest batch the geocoder accepts from its locator properties
+
+    Args:
+        geocoder: arcgis Geocoder returned by get_geocoders
+
+    example: max_batch_size(get_geocoders(gis)[1]) -> 1000
+    """
+    try:
+        size = geocoder.properties.locatorProperties.MaxBatchSize
+    except (AttributeError, KeyError):
+        return DEFAULT_BATCH_SIZE
+
+    return int(size) if size else DEFAULT_BATCH_SIZE
+
+
+def chunk_addresses(addresses: list, batch_size: int):
+    """
+    Splits addresses into (offset, batch) pairs where offset is the position of the batch's first address
+    """
+    return [(start, addresses[start:start + batch_size]) for start in range(0, len(addresses), batch_size)]
+
+
+def _geocode_batch(offset: int, batch: list, geocoder, source_country: str):
+    from arcgis.geocoding import batch_geocode
+
+    results = request('geocode', batch_geocode, batch, source_country=source_country, geocoder=geocoder)
+
+    # ResultID is the position inside the batch, shift it to the position in the full input
+    for result in results:
+        result['attributes']['ResultID'] += offset
+
+    return results
+
+
+def _cached_result(attributes: dict, position: int):
+    attributes = dict(attributes, ResultID=position)
+    return {'attributes': attributes, 'location': {'x': attributes['X'], 'y': attributes['Y']}}
+
+
+def geocode_addresses(addresses: list, geocoder, source_country: str = "USA",
+                      batch_size: int = None, max_workers: int = DEFAULT_WORKERS,
+                      cache=None, refresh: bool = False, keys: list = None):
+    """
+    Batch geocodes any number of addresses, results come back in input order
+
+    Args:
+        addresses (list): address strings
+        geocoder: arcgis Geocoder returned by get_geocoders
+        source_country (str): country code passed to batch_geocode
+        batch_size (int): addresses per request, defaults to the geocoder's max batch size
+        max_workers (int): number of batches in flight at the same time
+        cache (GeocodeCache): only addresses missing from the cache are sent to batch_geocode
+        refresh (bool): ignore cached results and geocode everything again, then update the cache
+        keys (list): canonical key per address (e.g. address_keys(df)), defaults to the normalized addresses
+
+    example: results = geocode_addresses(df.Address.to_list(), geocoder)
+
+    Addresses sharing a key are geocoded once, through the first address with that key, and
+    the result is copied to the others. Keys without any address are not geocoded.
+
+    Returns a list the same length as addresses, results[i] is the raw batch_geocode
+    result for addresses[i] (None if the geocoder did not return it)
+    """
+    keys = normalize_addresses(addresses) if keys is None else pd.Series(keys, dtype='string')
+    codes, unique_keys = pd.factorize(keys.to_numpy(dtype=object, na_value=None))
+
+    # every key is geocoded through its first row that has an address, keys with no address
+    # to send (e.g. Street/City/State/Zipcode given but Address empty) are dropped
+    present = pd.notna(pd.Series(addresses, dtype=object)).to_numpy()
+    first_code, first = np.unique(np.where(present, codes, -1), return_index=True)
+    first_code, first = first_code[first_code >= 0], first[first_code >= 0]
+
+    renumber = np.full(len(unique_keys) + 1, -1)
+    renumber[first_code] = np.arange(len(first_code))
+    codes = renumber[codes]
+    unique_keys = unique_keys[first_code].tolist()
+    print('Geocoding', len(unique_keys), 'unique addresses of', len(addresses))
+
+    unique = [None] * len(unique_keys)
+    pending = list(range(len(unique_keys)))
+
+    if cache is not None and not refresh:
+        hits = cache.get_many(unique_keys, geocoder.url, source_country)
+        for position, key in enumerate(unique_keys):
+            if key in hits:
+                unique[position] = _cached_result(hits[key], position)
+
+        pending = [position for position in pending if unique[position] is None]
+        print('Geocode cache hits:', len(unique_keys) - len(pending), 'of', len(unique_keys))
+
+    if pending:
+        batch_size = batch_size or max_batch_size(geocoder)
+        batches = chunk_addresses([addresses[first[position]] for position in pending], batch_size)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batches)))) as pool:
+            futures = [pool.submit(_geocode_batch, offset, batch, geocoder, source_country)
+                       for offset, batch in batches]
+
+            for future in as_completed(futures):
+                for result in future.result():
+                    # ResultID points into pending, map it back to the unique keys
+                    unique[pending[result['attributes']['ResultID']]] = result
+
+        if cache is not None:
+            # unmatched addresses are retried next run instead of being cached
+            cache.put_many({unique_keys[position]: unique[position]['attributes'] for position in pending
+                            if unique[position] is not None and unique[position]['attributes'].get('Status') != 'U'},
+                           geocoder.url, source_country)
+
+    # fan the results out to every row, duplicates get a copy with their own ResultID
+    ordered = [None] * len(addresses)
+    first = first.tolist()
+    for position, code in enumerate(codes.tolist()):
+        result = unique[code] if code >= 0 else None
+        if result is None:
+            continue
+        if position == first[code]:
+            result['attributes']['ResultID'] = position
+            ordered[position] = result
+        else:
+            ordered[position] = dict(result, attributes=dict(result['attributes'], ResultID=position))
+
+    return ordered
+
+
+def results_to_frame(results: list):
+    """
+    Builds one DataFrame of ResultID, X, Y, Score, Status, Match_addr from ordered geocode results
+
+    Args:
+        results (list): output of geocode_addresses, None entries become empty rows
+
+    example: location_df = results_to_frame(geocode_addresses(addresses, geocoder))
+
+    Row i of the frame is addresses[i], so it lines up with the input by position
+    """
+    n = len(results)
+    result_id = np.arange(n, dtype=np.int64)
+    x = np.full(n, np.nan)
+    y = np.full(n, np.nan)
+    score = np.full(n, np.nan)
+    status = np.full(n, None, dtype=object)
+    match_addr = np.full(n, None, dtype=object)
+
+    for i, result in enumerate(results):
+        if result is None:
+            continue
+        attributes = result['attributes']
+        x[i] = attributes.get('X', np.nan)
+        y[i] = attributes.get('Y', np.nan)
+        score[i] = attributes.get('Score', np.nan)
+        status[i] = attributes.get('Status')
+        match_addr[i] = attributes.get('Match_addr')
+
+    return pd.DataFrame({'ResultID': result_id, 'X': x, 'Y': y, 'Score': score,
+                         'Status': status, 'Match_addr': match_addr})
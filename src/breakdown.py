@@ -0,0 +1,188 @@
+import glob
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# race label, total pop, male pop, female pop, male age column prefix, female age column prefix
+RACES = [
+    ('White', 'WAGEBASECY', 'WHTMBASECY', 'WHTFBASECY', 'WHTM', 'WHTF'),
+    ('Black', 'BAGEBASECY', 'BLKMBASECY', 'BLKFBASECY', 'BLKM', 'BLKF'),
+    ('Native American', 'IAGEBASECY', 'AIMBASE_CY', 'AIFBASE_CY', 'AIM', 'AIF'),
+    ('Asian', 'AAGEBASECY', 'ASNMBASECY', 'ASNFBASECY', 'ASNM', 'ASNF'),
+    ('Pacific Islander', 'PAGEBASECY', 'PIMBASE_CY', 'PIFBASE_CY', 'PIM', 'PIF'),
+    ('Other Race', 'OAGEBASECY', 'OTHMBASECY', 'OTHFBASECY', 'OTHM', 'OTHF'),
+    ('Hispanic', 'HAGEBASECY', 'HSPMBASECY', 'HSPFBASECY', 'HSPM', 'HSPF'),
+]
+
+# age band label, 5 year esri age groups it is made of (e.g. WHTM65_CY + WHTM70_CY)
+AGE_BANDS = [
+    ('65-74', ['65', '70']),
+    ('75-84', ['75', '80']),
+    ('85+', ['85']),
+]
+
+SITE_COLUMN = 'OBJECTID'
+
+# file names of the tables print_breakdown writes, so they are not read back as inputs
+OUTPUT_PREFIX = 'Breakdown '
+
+
+def breakdown_spec():
+    """
+    Lists every breakdown measure as (race, sex, age, source columns summed for it)
+
+    example: ('White', 'Male', '65-74', ['WHTM65_CY', 'WHTM70_CY'])
+    """
+    spec = []
+
+    for race, total, male, female, male_prefix, female_prefix in RACES:
+        spec.append((race, 'All', 'All', [total]))
+
+        for sex, base, prefix in [('Male', male, male_prefix), ('Female', female, female_prefix)]:
+            spec.append((race, sex, 'All', [base]))
+
+            for age, groups in AGE_BANDS:
+                spec.append((race, sex, age, [prefix + group + '_CY' for group in groups]))
+
+    return spec
+
+
+def source_columns(spec: list = None):
+    """
+    Enriched columns the breakdown reads, in a stable order
+    """
+    columns = []
+    for _, _, _, measure_columns in spec or breakdown_spec():
+        columns += [column for column in measure_columns if column not in columns]
+    return columns
+
+
+def breakdown_table(df, per_site: bool = False, site_column: str = SITE_COLUMN):
+    """
+    Computes every race x sex x age measure in one pass over an enriched buffer table
+
+    Args:
+        df: enriched output with the agebyracebysex columns
+        per_site (bool): one set of measures per site instead of grand totals
+        site_column (str): column identifying the site when per_site is set
+
+    example: breakdown_table(pd.read_csv("output/Age and Race by Sex 3 Mile Buffer Mar 1.csv"))
+
+    Returns a long table with race, sex, age and population columns (plus site_column when per_site)
+    """
+    spec = breakdown_spec()
+    columns = source_columns(spec)
+
+    # columns x measures matrix of ones, so one matrix product sums every measure for every row
+    weights = np.zeros((len(columns), len(spec)))
+    for measure, (_, _, _, measure_columns) in enumerate(spec):
+        for column in measure_columns:
+            weights[columns.index(column), measure] = 1
+
+    values = df[columns].fillna(0).to_numpy(dtype=float) @ weights
+
+    labels = pd.DataFrame([measure[:3] for measure in spec], columns=['race', 'sex', 'age'])
+
+    if not per_site:
+        labels['population'] = values.sum(axis=0)
+        return labels
+
+    sites = np.repeat(df[site_column].to_numpy(), len(spec))
+    table = pd.concat([labels] * len(df), ignore_index=True)
+    table.insert(0, site_column, sites)
+    table['population'] = values.ravel()
+    return table
+
+
+def expand_paths(pattern: str):
+    """
+    Turns a csv path, a directory or a glob into a list of csv paths
+
+    example: expand_paths("output/csv/Age and Race by Sex 3 Mile Buffer*.csv")
+    """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.csv')
+
+    return sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+
+
+def has_breakdown_columns(file_path: str, per_site: bool = False):
+    """
+    Whether a csv's header has every column the breakdown reads, only the header is read
+    """
+    header = pd.read_csv(file_path, nrows=0).columns
+    return set(source_columns() + ([SITE_COLUMN] if per_site else [])).issubset(header)
+
+
+def breakdown_inputs(pattern: str, per_site: bool = False):
+    """
+    Enriched csvs a directory or glob holds, e.g. output/csv also has geocoded csvs and earlier breakdowns
+
+    Breakdown outputs are left out, other csvs without the breakdown columns are skipped with a warning.
+    """
+    file_paths = []
+    for file_path in expand_paths(pattern):
+        if os.path.basename(file_path).startswith(OUTPUT_PREFIX):
+            continue
+        if not has_breakdown_columns(file_path, per_site):
+            print('Skipping', file_path + ', it has no enriched race columns' + (' or OBJECTID' if per_site else ''))
+            continue
+        file_paths.append(file_path)
+
+    return file_paths
+
+
+def report_date(file_path: str):
+    """
+    Reporting period at the end of an enriched file name, None if it has none
+
+    example: "output/csv/Age and Race by Sex 3 Mile Buffer Mar 15.csv" -> "Mar 15"
+    """
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    match = re.search(r'([A-Z][a-z]{2} \d{1,2})(?: (\d{4}))?$', name)
+
+    return ' '.join(group for group in match.groups() if group) if match else None
+
+
+def _date_order(date: str):
+    for date_format in ('%b %d %Y', '%b %d'):
+        try:
+            return datetime.strptime(date, date_format)
+        except (TypeError, ValueError):
+            pass
+    return datetime.max
+
+
+def breakdown_file(file_path: str, per_site: bool = False):
+    """
+    Reads only the breakdown columns of one enriched csv and breaks it down, tagged with file and date
+    """
+    usecols = source_columns() + ([SITE_COLUMN] if per_site else [])
+    table = breakdown_table(pd.read_csv(file_path, usecols=usecols), per_site=per_site)
+
+    table.insert(0, 'date', report_date(file_path))
+    table.insert(0, 'file', os.path.basename(file_path))
+    return table
+
+
+def breakdown_files(file_paths: list, per_site: bool = False, max_workers: int = None):
+    """
+    Breaks down many enriched csvs in parallel processes into one long table keyed by file and date
+
+    Args:
+        file_paths (list): enriched csvs, e.g. one per reporting period
+        per_site (bool): one set of measures per site instead of grand totals
+        max_workers (int): worker processes, defaults to the number of cores
+
+    example: breakdown_files(breakdown_inputs("output/csv/Age and Race by Sex*.csv"))
+    """
+    file_paths = sorted(file_paths, key=lambda path: (_date_order(report_date(path)), path))
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        tables = list(pool.map(breakdown_file, file_paths, [per_site] * len(file_paths)))
+
+    return pd.concat(tables, ignore_index=True)
@@ -0,0 +1,200 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+# local caches live next to the rest of the generated output
+CACHE_DIR = 'output/cache'
+
+# geocoder results are stable, but addresses do get re-pointed, so refresh every 90 days
+GEOCODE_TTL = 90 * 24 * 60 * 60
+GEOCODE_MAX_ENTRIES = 500000
+
+# ArcGIS Online tokens last 2 hours by default, stop reusing them a bit before that
+TOKEN_TTL = 100 * 60
+TOKEN_PATH = CACHE_DIR + '/token.json'
+
+ENRICH_INDEX_PATH = CACHE_DIR + '/enrich.json'
+
+# the GeoEnrichment variable catalog only changes with esri's yearly data release
+CATALOG_TTL = 30 * 24 * 60 * 60
+CATALOG_PATH = CACHE_DIR + '/us_data_collections.pkl'
+
+# sqlite limits the number of parameters in a single statement
+_SQL_CHUNK = 500
+
+
+def load_json(path: str, default=None):
+    """
+    Reads a json state file, returns default when it does not exist yet
+    """
+    if not os.path.exists(path):
+        return default
+
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_json(path: str, data, mode: int = 0o666):
+    """
+    Writes a json state file atomically so a crash never leaves half a file behind
+
+    The file is created with mode (less the umask) before anything is written to it
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    # a leftover temp file would keep its old permissions, so start from a fresh one
+    if os.path.exists(path + '.tmp'):
+        os.remove(path + '.tmp')
+
+    with os.fdopen(os.open(path + '.tmp', os.O_CREAT | os.O_EXCL | os.O_WRONLY, mode), 'w') as file:
+        json.dump(data, file, indent=2)
+        file.flush()
+        os.fsync(file.fileno())
+
+    os.replace(path + '.tmp', path)
+
+
+def fingerprint(*parts):
+    """
+    Stable sha256 of any json serializable values, used as a content address for cached results
+
+    example: fingerprint(features, variables, {'distance': 3}) -> '9f2c...'
+    """
+    payload = json.dumps(parts, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def load_token(url: str, username: str, path: str = TOKEN_PATH):
+    """
+    Returns the cached token for this portal and user, None if there is none or it expired
+    """
+    cached = load_json(path, {})
+
+    if cached.get('url') != url or cached.get('username') != username:
+        return None
+    if cached.get('expires', 0) <= time.time():
+        return None
+
+    return cached['token']
+
+
+def save_token(url: str, username: str, token: str, ttl: float = TOKEN_TTL, path: str = TOKEN_PATH):
+    """
+    Stores a login token so the next run can skip the login round trip, readable by the owner only
+    """
+    save_json(path, {'url': url, 'username': username, 'token': token, 'expires': time.time() + ttl}, mode=0o600)
+
+
+def clear_token(path: str = TOKEN_PATH):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+class EnrichCache(object):
+    """
+    Maps the fingerprint of an enrichment job (input features, variables, buffer) to the item it produced
+    """
+    def __init__(self, path: str = ENRICH_INDEX_PATH):
+
+        self.path = path
+        self.index = load_json(path, {})
+
+    def get(self, key: str):
+        return self.index.get(key)
+
+    def put(self, key: str, **entry):
+        entry['created'] = time.time()
+        self.index[key] = entry
+        save_json(self.path, self.index)
+
+    def drop(self, key: str):
+        if self.index.pop(key, None) is not None:
+            save_json(self.path, self.index)
+
+
+class GeocodeCache(object):
+    """
+    SQLite cache of geocode results keyed by canonical address (see address.py), geocoder and source country
+    """
+    def __init__(self, path: str = CACHE_DIR + '/geocode.sqlite',
+                 ttl: float = GEOCODE_TTL, max_entries: int = GEOCODE_MAX_ENTRIES):
+
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS geocode (
+                address TEXT NOT NULL,
+                geocoder TEXT NOT NULL,
+                source_country TEXT NOT NULL,
+                x REAL, y REAL, score REAL,
+                match_addr TEXT, status TEXT,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY (address, geocoder, source_country))""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS geocode_accessed ON geocode (accessed)")
+        self.conn.commit()
+
+    def get_many(self, addresses: list, geocoder: str, source_country: str):
+        """
+        Looks up normalized addresses, returns {address: attributes} for the ones that are cached and not expired
+        """
+        now = time.time()
+        addresses = list(set(addresses))
+        found = {}
+
+        for start in range(0, len(addresses), _SQL_CHUNK):
+            chunk = addresses[start:start + _SQL_CHUNK]
+            rows = self.conn.execute(
+                "SELECT address, x, y, score, match_addr, status FROM geocode "
+                "WHERE geocoder = ? AND source_country = ? AND created > ? "
+                "AND address IN (%s)" % ','.join('?' * len(chunk)),
+                [geocoder, source_country, now - self.ttl] + chunk)
+
+            for address, x, y, score, match_addr, status in rows:
+                found[address] = {'X': x, 'Y': y, 'Score': score,
+                                  'Match_addr': match_addr, 'Status': status}
+
+        hits = list(found)
+        for start in range(0, len(hits), _SQL_CHUNK):
+            chunk = hits[start:start + _SQL_CHUNK]
+            self.conn.execute(
+                "UPDATE geocode SET accessed = ? WHERE geocoder = ? AND source_country = ? "
+                "AND address IN (%s)" % ','.join('?' * len(chunk)),
+                [now, geocoder, source_country] + chunk)
+        self.conn.commit()
+
+        return found
+
+    def put_many(self, entries: dict, geocoder: str, source_country: str):
+        """
+        Stores {normalized address: attributes} where attributes is a batch_geocode 'attributes' dict
+        """
+        now = time.time()
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(address, geocoder, source_country, a.get('X'), a.get('Y'), a.get('Score'),
+              a.get('Match_addr'), a.get('Status'), now, now)
+             for address, a in entries.items()])
+        self.conn.commit()
+        self.evict()
+
+    def evict(self):
+        """
+        Drops expired entries, then the least recently used ones above max_entries
+        """
+        self.conn.execute("DELETE FROM geocode WHERE created <= ?", (time.time() - self.ttl,))
+        self.conn.execute(
+            "DELETE FROM geocode WHERE rowid IN "
+            "(SELECT rowid FROM geocode ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
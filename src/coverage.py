@@ -0,0 +1,175 @@
+import numpy as np
+import pandas as pd
+import shapely
+
+from .local_enrich import apportion
+from .spatial import METERS_PER_MILE, PROJECTED_CRS
+
+SQUARE_METERS_PER_SQUARE_MILE = METERS_PER_MILE ** 2
+
+
+def nearest_zones(points, buffers):
+    """
+    Cuts every buffer down to the part where its site is the closest site, the Voronoi cell
+
+    Args:
+        points: array of distinct projected points
+        buffers: the same size buffer around each point
+
+    The zones do not overlap and together cover the union of the buffers, so counts apportioned
+    into them add up to the deduplicated total.
+    """
+    extent = shapely.box(*shapely.total_bounds(buffers))
+    cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(points), extend_to=extent))
+
+    # voronoi_polygons does not keep the input order, each point lies inside its own cell
+    point_index, cell_index = shapely.STRtree(cells).query(points, predicate='within')
+    ordered = np.empty(len(points), dtype=object)
+    ordered[point_index] = cells[cell_index]
+
+    return shapely.intersection(buffers, ordered)
+
+
+def voronoi_neighbours(points):
+    """
+    Pairs of distinct points whose Voronoi cells share an edge, from their Delaunay triangulation
+
+    Returns (site_index, other_index) sorted by site_index, each pair appears both ways
+    """
+    edges = shapely.delaunay_triangles(shapely.multipoints(points), only_edges=True)
+    ends = shapely.get_coordinates(edges).reshape(-1, 2, 2)
+
+    coordinates = shapely.get_coordinates(points)
+    index = pd.MultiIndex.from_arrays([coordinates[:, 0], coordinates[:, 1]])
+    start = index.get_indexer(pd.MultiIndex.from_arrays([ends[:, 0, 0], ends[:, 0, 1]]))
+    end = index.get_indexer(pd.MultiIndex.from_arrays([ends[:, 1, 0], ends[:, 1, 1]]))
+
+    site_index, other_index = np.concatenate([start, end]), np.concatenate([end, start])
+    order = np.argsort(site_index, kind='stable')
+    return site_index[order], other_index[order]
+
+
+def exclusive_zones(points, radius: float):
+    """
+    Cuts each site's buffer down to the area no other site's buffer covers
+
+    Args:
+        points: array of projected points
+        radius (float): buffer radius in the crs units
+
+    Returns (buffers, nearest, exclusive), one polygon per point.
+
+    A point only one buffer covers is closest to that buffer's site, and the second closest site
+    to any point of a Voronoi cell is one of the cell's neighbours. So the exclusive area is the
+    site's nearest zone minus its Voronoi neighbours' buffers, a handful of differences per site
+    however many buffers overlap. Sites sharing a location have no exclusive area.
+    """
+    points = np.asarray(points)
+    buffers = shapely.buffer(points, radius)
+
+    _, first, counts = np.unique(shapely.get_coordinates(points), axis=0, return_index=True, return_counts=True)
+    distinct = points[first]
+
+    nearest = np.full(len(points), shapely.Polygon(), dtype=object)
+    nearest[first] = nearest_zones(distinct, buffers[first])
+
+    # difference the k-th neighbour of every site at once, rounds = the most neighbours any site has
+    site_index, other_index = voronoi_neighbours(distinct)
+    near = shapely.distance(distinct[site_index], distinct[other_index]) < 2 * radius
+    site_index, other_index = site_index[near], other_index[near]
+    rank = np.arange(len(site_index)) - np.searchsorted(site_index, site_index)
+
+    exclusive = nearest[first]
+    for round_ in range(rank.max() + 1 if len(rank) else 0):
+        sites = site_index[rank == round_]
+        exclusive[sites] = shapely.difference(exclusive[sites], buffers[first][other_index[rank == round_]])
+    exclusive[counts > 1] = shapely.Polygon()
+
+    zones = np.full(len(points), shapely.Polygon(), dtype=object)
+    zones[first] = exclusive
+    return buffers, nearest, zones
+
+
+def site_coverage(points, miles: float, block_groups, variables: list):
+    """
+    Splits overlapping site buffers into what each site covers alone and what they cover together
+
+    Args:
+        points: array of projected points, one per site
+        miles (float): buffer radius
+        block_groups: output of load_block_groups
+        variables (list): demographic columns to apportion
+
+    example: site_coverage(np.asarray(sites.geometry.to_crs(PROJECTED_CRS)), 3, block_groups, load_variables())
+
+    Returns (sites, exclusive, total, summed):
+        sites: overlapping_sites, buffer, exclusive, shared and nearest square miles per site.
+               The nearest areas, where the site is the closest one, add up to the covered area
+        exclusive: variables apportioned into each site's exclusive area, i.e. the site's marginal
+                   coverage, what would no longer be covered without it
+        total: one row of variables apportioned into the union of the buffers, nobody counted twice
+        summed: one row of the per buffer counts added up, what summing the enrich output gives
+    """
+    points = np.asarray(points)
+    radius = miles * METERS_PER_MILE
+    buffers, nearest, zones = exclusive_zones(points, radius)
+
+    site_index, other_index = shapely.STRtree(points).query(points, predicate='dwithin', distance=2 * radius)
+    overlaps = np.bincount(site_index[site_index != other_index], minlength=len(points))
+
+    area = shapely.area(buffers) / SQUARE_METERS_PER_SQUARE_MILE
+    exclusive_area = shapely.area(zones) / SQUARE_METERS_PER_SQUARE_MILE
+    sites = pd.DataFrame({'overlapping_sites': overlaps, 'buffer_sq_miles': area,
+                          'exclusive_sq_miles': exclusive_area, 'shared_sq_miles': area - exclusive_area,
+                          'nearest_sq_miles': shapely.area(nearest) / SQUARE_METERS_PER_SQUARE_MILE})
+
+    union = shapely.union_all(buffers)
+    exclusive = pd.DataFrame(apportion(zones, block_groups, variables), columns=variables)
+    total = pd.DataFrame(apportion([union], block_groups, variables), columns=variables)
+    total.insert(0, 'sq_miles', shapely.area(union) / SQUARE_METERS_PER_SQUARE_MILE)
+
+    summed = pd.DataFrame(apportion(buffers, block_groups, variables), columns=variables).sum().to_frame().T
+    summed.insert(0, 'sq_miles', area.sum())
+
+    return sites, exclusive, total, summed
+
+
+def cover_sites(sites, block_groups, radii: list, variables: list):
+    """
+    Buffers sites by each radius and works out their overlap aware coverage
+
+    Args:
+        sites: point GeoDataFrame, e.g. read_points("output/csv/Geocoded Mobile Sites.csv")
+        block_groups: output of load_block_groups
+        radii (list): buffer distances in miles
+        variables (list): demographic columns to apportion
+
+    example: cover_sites(sites, block_groups, [3], load_variables())
+
+    Returns {radius: (table, total, summed)}. table is shaped like the enrich_layer output,
+    the site columns, OBJECTID, bufferUnits and bufferRadii, then the site_coverage areas and
+    the variables counted in the site's exclusive area. total is the union row shaped the same
+    way, summed the per buffer counts added up.
+    """
+    attributes = pd.DataFrame(sites.drop(columns=sites.geometry.name)).reset_index(drop=True)
+    if 'OBJECTID' not in attributes:
+        attributes.insert(0, 'OBJECTID', np.arange(1, len(attributes) + 1))
+
+    points = np.asarray(sites.geometry.to_crs(PROJECTED_CRS))
+    covered = {}
+
+    for radius in radii:
+        coverage, exclusive, total, summed = site_coverage(points, radius, block_groups, variables)
+
+        table = attributes.copy()
+        table['bufferUnits'] = 'Miles'
+        table['bufferRadii'] = radius
+        table = pd.concat([table, coverage, exclusive], axis=1)
+
+        total.insert(0, 'bufferRadii', radius)
+        total.insert(0, 'bufferUnits', 'Miles')
+        total.insert(0, 'OBJECTID', 1)
+
+        covered[radius] = (table, total, summed)
+
+    return covered
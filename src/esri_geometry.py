@@ -0,0 +1,94 @@
+import shapely
+from shapely.geometry import LineString, MultiLineString, MultiPoint, MultiPolygon, Point, Polygon
+
+
+def dequantize(rings: list, transform: dict):
+    """
+    Turns quantized, delta encoded paths or rings back into map coordinates
+
+    Args:
+        rings (list): lists of [x, y] integer vertices, each vertex after the first being an offset from the previous one
+        transform (dict): 'transform' of a query response made with quantizationParameters
+    """
+    scale_x, scale_y = transform['scale'][:2]
+    translate_x, translate_y = transform['translate'][:2]
+    flip = -1 if transform.get('originPosition', 'upperLeft') == 'upperLeft' else 1
+
+    decoded = []
+    for ring in rings:
+        x = y = 0
+        points = []
+        for dx, dy in ring:
+            x += dx
+            y += dy
+            points.append((translate_x + x * scale_x, translate_y + flip * y * scale_y))
+        decoded.append(points)
+
+    return decoded
+
+
+def _polygon(rings: list):
+    """
+    Esri rings are clockwise for outer boundaries and counterclockwise for holes
+    """
+    shells, holes = [], []
+    for ring in rings:
+        if len(ring) < 4:
+            continue
+        (holes if shapely.LinearRing(ring).is_ccw else shells).append(ring)
+
+    polygons = [[shell, []] for shell in shells]
+    shapes = [Polygon(shell) for shell in shells]
+
+    for hole in holes:
+        inside = Point(hole[0])
+        for polygon, shape in zip(polygons, shapes):
+            if shape.contains(inside):
+                polygon[1].append(hole)
+                break
+
+    polygons = [Polygon(shell, hole_rings) for shell, hole_rings in polygons]
+    if not polygons:
+        return None
+    return polygons[0] if len(polygons) == 1 else MultiPolygon(polygons)
+
+
+def to_shapely(geometry: dict, transform: dict = None):
+    """
+    Converts one esri json geometry (point, multipoint, polyline or polygon) to shapely
+
+    example: to_shapely({'x': -118.2, 'y': 34.0}) -> POINT (-118.2 34)
+    """
+    if not geometry:
+        return None
+
+    if 'x' in geometry:
+        if transform is None:
+            return Point(geometry['x'], geometry['y'])
+        return Point(dequantize([[(geometry['x'], geometry['y'])]], transform)[0][0])
+
+    if 'points' in geometry:
+        points = geometry['points']
+        points = dequantize([points], transform)[0] if transform else points
+        return MultiPoint([point[:2] for point in points])
+
+    if 'paths' in geometry:
+        paths = dequantize(geometry['paths'], transform) if transform else geometry['paths']
+        lines = [LineString([point[:2] for point in path]) for path in paths if len(path) > 1]
+        return lines[0] if len(lines) == 1 else MultiLineString(lines)
+
+    if 'rings' in geometry:
+        rings = dequantize(geometry['rings'], transform) if transform else geometry['rings']
+        return _polygon([[point[:2] for point in ring] for ring in rings])
+
+    return None
+
+
+def crs_of(spatial_reference: dict):
+    """
+    pyproj friendly crs for an esri spatialReference, web mercator's 102100 becomes EPSG:3857
+    """
+    wkid = spatial_reference.get('latestWkid') or spatial_reference.get('wkid')
+    if wkid == 102100:
+        wkid = 3857
+    return 'EPSG:%d' % wkid if wkid else spatial_reference.get('wkt')
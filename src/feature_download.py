@@ -0,0 +1,294 @@
+import importlib.util
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .cache import load_json, save_json
+from .scheduler import request
+
+# used when a layer does not report its maxRecordCount
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_WORKERS = 4
+
+
+def page_size(layer):
+    """
+    Largest number of records the layer returns from a single query
+    """
+    return int(layer.properties.get('maxRecordCount') or DEFAULT_PAGE_SIZE)
+
+
+def object_id_pages(object_ids: list, size: int):
+    """
+    Splits object IDs into (first, last) ranges holding at most size IDs each
+
+    example: object_id_pages([1, 2, 3, 7, 9], 2) -> [(1, 2), (3, 7), (9, 9)]
+    """
+    object_ids = sorted(object_ids)
+    return [(object_ids[start], object_ids[min(start + size, len(object_ids)) - 1])
+            for start in range(0, len(object_ids), size)]
+
+
+def _query_page(layer, oid_field: str, where: str, first: int, last: int, query_params: dict):
+    page_where = '(%s) AND %s >= %d AND %s <= %d' % (where, oid_field, first, oid_field, last)
+    return request('query', layer.query, where=page_where, **query_params)
+
+
+def iter_pages(layer, where: str = '1=1', max_workers: int = DEFAULT_WORKERS, size: int = None, **query_params):
+    """
+    Yields the layer's records as DataFrames, one page at a time and in object ID order
+
+    Args:
+        layer: arcgis FeatureLayer
+        where (str): filter applied before paging
+        max_workers (int): pages fetched at the same time
+        size (int): records per page, defaults to the layer's maxRecordCount
+        query_params: passed on to layer.query (out_fields, return_geometry, ...), pages are
+                      DataFrames unless as_df=False is passed
+
+    example: for page in iter_pages(layer, out_fields='*', return_geometry=False): ...
+
+    At most 2 * max_workers pages are held in memory at once.
+    """
+    query_params.setdefault('as_df', True)
+    oid_field = layer.properties.objectIdField
+    object_ids = request('query', layer.query, where=where, return_ids_only=True).get('objectIds') or []
+    pages = object_id_pages(object_ids, size or page_size(layer))
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        in_flight = deque()
+
+        for first, last in pages:
+            in_flight.append(pool.submit(_query_page, layer, oid_field, where, first, last, query_params))
+
+            if len(in_flight) >= 2 * max_workers:
+                yield in_flight.popleft().result()
+
+        while in_flight:
+            yield in_flight.popleft().result()
+
+
+def download_csv(layer, csv_path: str, where: str = '1=1', max_workers: int = DEFAULT_WORKERS, **query_params):
+    """
+    Pages through a layer and streams every page into a csv, returns the number of rows written
+
+    The csv is written next to csv_path first and moved into place once complete
+    """
+    rows = 0
+    header = True
+    partial_path = csv_path + '.partial'
+
+    with open(partial_path, 'w', newline='') as output:
+        for page in iter_pages(layer, where, max_workers, **query_params):
+            page.to_csv(output, index=False, header=header)
+            header = False
+            rows += len(page)
+
+    os.replace(partial_path, csv_path)
+    return rows
+
+
+def compact_dtypes(df, category_ratio: float = 0.5):
+    """
+    Shrinks a DataFrame's dtypes without changing any value
+
+    Repeated strings become categoricals, integers are downcast, and float64 columns become
+    float32 when every value survives the round trip (e.g. whole number counts).
+    """
+    df = df.copy()
+
+    for column in df.columns:
+        values = df[column]
+
+        if pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values):
+            if len(values) and values.nunique() <= category_ratio * len(values):
+                df[column] = values.astype('category')
+
+        elif pd.api.types.is_integer_dtype(values):
+            df[column] = pd.to_numeric(values, downcast='integer')
+
+        elif pd.api.types.is_float_dtype(values) and values.dtype == np.float64:
+            as_float32 = values.astype(np.float32)
+            if np.array_equal(as_float32.astype(np.float64).to_numpy(), values.to_numpy(), equal_nan=True):
+                df[column] = as_float32
+
+    return df
+
+
+def require_parquet(engines: tuple = ('pyarrow', 'fastparquet')):
+    """
+    Raises ImportError when none of the parquet engines is installed, checked before any page is downloaded
+    """
+    if not any(importlib.util.find_spec(engine) for engine in engines):
+        raise ImportError('Writing parquet needs %s, e.g. pip install %s' % (' or '.join(engines), engines[0]))
+
+
+def download_parquet(layer, parquet_path: str, where: str = '1=1', max_workers: int = DEFAULT_WORKERS,
+                     **query_params):
+    """
+    Pages through a layer and saves it as a compact parquet file, returns the number of rows written
+
+    Needs pyarrow or fastparquet. Pages are combined before writing so the dtypes can be compacted over
+    the whole layer, so unlike download_csv the full table is held in memory once.
+    """
+    require_parquet()
+
+    pages = list(iter_pages(layer, where, max_workers, **query_params))
+    df = compact_dtypes(pd.concat(pages, ignore_index=True)) if pages else pd.DataFrame()
+
+    df.to_parquet(parquet_path + '.partial', index=False)
+    os.replace(parquet_path + '.partial', parquet_path)
+    return len(df)
+
+
+def download_geodata(layer, path: str, driver: str = 'GPKG', where: str = '1=1',
+                     max_workers: int = DEFAULT_WORKERS, out_sr: int = None, max_allowable_offset: float = None,
+                     geometry_precision: int = None, quantize: float = None):
+    """
+    Pages through a layer with its geometry and writes a spatial file, returns the number of rows written
+
+    Args:
+        layer: arcgis FeatureLayer
+        path (str): output file
+        driver (str): 'GPKG', 'FlatGeobuf' or 'Parquet' (GeoParquet, needs pyarrow)
+        where (str): filter applied before paging
+        max_workers (int): pages fetched at the same time
+        out_sr (int): wkid the server projects the geometry to, e.g. 4326
+        max_allowable_offset (float): server side generalization, in units of the output crs
+        geometry_precision (int): decimal places the server rounds coordinates to
+        quantize (float): snap vertices to a grid this size (layer units) on the server, dropping
+                          the vertices that collapse. Uses the layer's own crs, so out_sr is ignored
+
+    The geometry options trade precision for smaller responses, which is fine for map scale work.
+    """
+    if driver == 'Parquet':
+        # geopandas only writes GeoParquet through pyarrow
+        require_parquet(('pyarrow',))
+
+    import geopandas as gpd
+
+    from .esri_geometry import crs_of, to_shapely
+
+    params = {'out_fields': '*', 'return_geometry': True, 'as_df': False, 'as_raw': True}
+    if max_allowable_offset is not None:
+        params['max_allowable_offset'] = max_allowable_offset
+    if geometry_precision is not None:
+        params['geometry_precision'] = geometry_precision
+
+    if quantize is not None:
+        if out_sr is not None:
+            print('out_sr is ignored when quantizing, geometry stays in the layer crs')
+        params['quantization_parameters'] = {'mode': 'view', 'originPosition': 'upperLeft', 'tolerance': quantize,
+                                             'extent': dict(layer.properties.extent)}
+    elif out_sr is not None:
+        params['out_sr'] = out_sr
+
+    frames = []
+    crs = None
+    for page in iter_pages(layer, where, max_workers, **params):
+        transform = page.get('transform')
+        features = page.get('features', [])
+        crs = crs or crs_of(page.get('spatialReference') or layer.properties.extent['spatialReference'])
+
+        frames.append(gpd.GeoDataFrame([feature['attributes'] for feature in features],
+                                       geometry=[to_shapely(feature.get('geometry'), transform) for feature in features],
+                                       crs=crs))
+
+    gdf = pd.concat(frames, ignore_index=True) if frames else gpd.GeoDataFrame(geometry=[])
+
+    if driver == 'Parquet':
+        gdf.to_parquet(path, index=False)
+    else:
+        gdf.to_file(path, driver=driver)
+    return len(gdf)
+
+
+def edit_date_field(layer):
+    """
+    Name of the field the service stamps on every edit, None when editor tracking is off
+    """
+    edit_fields = layer.properties.get('editFieldsInfo') or {}
+    return edit_fields.get('editDateField')
+
+
+def _watermark(df, oid_field: str, edit_field: str):
+    if df.empty:
+        return None
+    if edit_field:
+        return str(pd.to_datetime(df[edit_field]).max())
+    return int(df[oid_field].max())
+
+
+def sync_csv(layer, csv_path: str, state_path: str, since: str = None, max_workers: int = DEFAULT_WORKERS,
+             **query_params):
+    """
+    Brings a csv downloaded from a layer up to date by fetching only rows changed since the last sync
+
+    Args:
+        layer: arcgis FeatureLayer
+        csv_path (str): local copy of the layer, downloaded in full when it does not exist yet
+        state_path (str): json file holding the watermark of the last sync
+        since (str): fetch rows edited after this time instead of the stored watermark, e.g. "2021-03-15".
+                     Without editor tracking an object ID, rows with a higher one are fetched
+        max_workers (int): pages fetched at the same time
+        query_params: passed on to layer.query (out_fields, return_geometry, ...)
+
+    example: sync_csv(layer, 'output/csv/Vaccination Sites.csv', 'output/cache/sync/<item id>.json')
+
+    The watermark is the latest edit date when editor tracking is on, otherwise the highest
+    object ID (which only catches new rows). Rows deleted on the server are found by comparing
+    object IDs and dropped from the csv.
+
+    Returns (rows changed, rows deleted)
+    """
+    oid_field = layer.properties.objectIdField
+    edit_field = edit_date_field(layer)
+    state = load_json(state_path)
+
+    if since is not None and edit_field is None and not str(since).strip().isdigit():
+        raise ValueError('%s has no editor tracking, since takes an %s to sync rows after, not %r'
+                         % (layer.properties.get('name', layer.url), oid_field, since))
+
+    if not os.path.exists(csv_path) or (state is None and since is None):
+        rows = download_csv(layer, csv_path, max_workers=max_workers, **query_params)
+        usecols = [oid_field, edit_field] if edit_field else [oid_field]
+        watermark = _watermark(pd.read_csv(csv_path, usecols=usecols), oid_field, edit_field)
+        save_json(state_path, {'url': layer.url, 'edit_field': edit_field, 'watermark': watermark})
+        return rows, 0
+
+    watermark = since if since is not None else state['watermark']
+
+    if watermark is None:
+        where = '1=1'
+    elif edit_field:
+        where = "%s > timestamp '%s'" % (edit_field, pd.Timestamp(watermark).strftime('%Y-%m-%d %H:%M:%S'))
+    else:
+        where = '%s > %d' % (oid_field, int(watermark))
+
+    pages = list(iter_pages(layer, where, max_workers, **query_params))
+    changed = pd.concat(pages, ignore_index=True) if pages else pd.DataFrame()
+
+    server_ids = set(request('query', layer.query, where='1=1', return_ids_only=True).get('objectIds') or [])
+    local = pd.read_csv(csv_path)
+    deleted = ~local[oid_field].isin(server_ids)
+
+    replaced = local[oid_field].isin(changed[oid_field]) if not changed.empty else False
+    local = local[~(deleted | replaced)].copy()
+
+    if edit_field and not changed.empty:
+        local[edit_field] = pd.to_datetime(local[edit_field])
+
+    merged = pd.concat([local, changed], ignore_index=True).sort_values(oid_field)
+    merged.to_csv(csv_path + '.partial', index=False)
+    os.replace(csv_path + '.partial', csv_path)
+
+    # every changed row is newer than the old watermark, so its max only moves forward
+    new_watermark = _watermark(changed, oid_field, edit_field)
+    if new_watermark is not None:
+        watermark = new_watermark
+    save_json(state_path, {'url': layer.url, 'edit_field': edit_field, 'watermark': watermark})
+
+    return len(changed), int(deleted.sum())
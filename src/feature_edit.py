@@ -0,0 +1,164 @@
+import math
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .feature_download import iter_pages
+from .scheduler import request
+
+# features per edit_features request
+EDIT_BATCH_SIZE = 500
+DEFAULT_WORKERS = 4
+
+WEB_MERCATOR = (102100, 3857)
+WEB_MERCATOR_RADIUS = 6378137.0
+
+
+def find_layer(gis, title: str):
+    """
+    Returns the hosted feature layer item with exactly this title, None if there is none
+    """
+    for item in request('content', gis.content.search, 'title:"%s"' % title, item_type='Feature Layer'):
+        if item.title == title:
+            return item
+    return None
+
+
+def field_names(df, layer):
+    """
+    Maps csv columns to the layer fields they were published as, e.g. 'Mobile Site' -> 'Mobile_Site'
+
+    Columns without a matching field are left out
+    """
+    fields = {field['name'].lower(): field['name'] for field in layer.properties.fields}
+    names = {}
+
+    for column in df.columns:
+        field = fields.get(re.sub(r'\W', '_', str(column)).lower())
+        if field is not None:
+            names[column] = field
+
+    return names
+
+
+def _changed(local, remote):
+    """
+    Row mask of local/remote pairs that differ in any column, numbers compared as numbers
+    """
+    changed = np.zeros(len(local), dtype=bool)
+
+    for column in local.columns:
+        a, b = local[column], remote[column]
+        a_number, b_number = pd.to_numeric(a, errors='coerce'), pd.to_numeric(b, errors='coerce')
+        numeric = (a_number.notna() & b_number.notna()).to_numpy()
+
+        same_number = np.isclose(a_number.to_numpy(dtype=float), b_number.to_numpy(dtype=float))
+        same_text = (a.fillna('').astype(str) == b.fillna('').astype(str)).to_numpy()
+        changed |= np.where(numeric, ~same_number, ~same_text)
+
+    return changed
+
+
+def diff_layer(df, layer, key: str, max_workers: int = DEFAULT_WORKERS):
+    """
+    Compares a csv with the rows already in a layer on a key column
+
+    Args:
+        df: local rows, with columns already renamed to the layer's field names
+        layer: arcgis FeatureLayer
+        key (str): field identifying a row, e.g. 'Address' or 'ResultID'
+        max_workers (int): pages fetched at the same time
+
+    Returns (adds, updates, deletes): adds and updates are DataFrames of local rows (updates
+    carry the layer's object ID), deletes is a list of object IDs whose key is gone from df.
+    Rows sharing a key are paired by their order within the key, extra local ones are added
+    and extra remote ones deleted
+    """
+    oid_field = layer.properties.objectIdField
+    df = df.drop(columns=[oid_field], errors='ignore')
+    columns = list(df.columns)
+
+    pages = list(iter_pages(layer, max_workers=max_workers, return_geometry=False,
+                            out_fields=','.join([oid_field] + columns)))
+    remote = pd.concat(pages, ignore_index=True) if pages else pd.DataFrame(columns=[oid_field] + columns)
+    # a key can repeat (the same address twice), its rows are paired by their order within the
+    # key, the layer's in object ID order, so every local row matches at most one remote row
+    local = df.assign(_occurrence=df.groupby(key, dropna=False, sort=False).cumcount().to_numpy())
+    remote = remote.sort_values(oid_field, kind='stable')
+    remote['_occurrence'] = remote.groupby(key, dropna=False, sort=False).cumcount().to_numpy()
+    pair = [key, '_occurrence']
+
+    # pairs are unique on both sides, so the left merge keeps df's rows one to one and can keep its index
+    matched = local.merge(remote, on=pair, how='left', suffixes=('', '_remote'), indicator=True)
+    matched.index = df.index
+
+    adds = df[(matched['_merge'] == 'left_only').to_numpy()]
+
+    both = matched[(matched['_merge'] == 'both').to_numpy()]
+    compare = [column for column in columns if column != key]
+    local_values = both[compare]
+    remote_values = both[[column + '_remote' for column in compare]].set_axis(compare, axis=1)
+    updates = both[_changed(local_values, remote_values)][columns + [oid_field]]
+    updates = updates.astype({oid_field: 'int64'})
+
+    # remote rows left unpaired, their key is gone from df or df repeats it fewer times
+    unpaired = remote[pair].merge(local[pair], on=pair, how='left', indicator=True)['_merge'] == 'left_only'
+    deletes = remote.loc[unpaired.to_numpy(), oid_field].tolist()
+
+    return adds, updates, deletes
+
+
+def to_features(df, xy=None, wkid: int = 4326):
+    """
+    Turns rows into edit_features dicts
+
+    Args:
+        df: rows with columns named like the layer's fields
+        xy: DataFrame with X and Y (lon/lat) columns on the same index as df, used as point geometry
+        wkid (int): spatial reference of the layer, points are projected to web mercator when needed
+    """
+    attributes = df.astype(object).where(df.notna(), None).to_dict('records')
+
+    if xy is None:
+        return [{'attributes': row} for row in attributes]
+
+    xy = xy.loc[df.index]
+    xs, ys = xy['X'].to_numpy(dtype=float), xy['Y'].to_numpy(dtype=float)
+    if wkid in WEB_MERCATOR:
+        xs = np.radians(xs) * WEB_MERCATOR_RADIUS
+        ys = np.log(np.tan(math.pi / 4 + np.radians(ys) / 2)) * WEB_MERCATOR_RADIUS
+
+    return [{'attributes': row, 'geometry': {'x': px, 'y': py, 'spatialReference': {'wkid': wkid}}}
+            for row, px, py in zip(attributes, xs.tolist(), ys.tolist())]
+
+
+def _edit_batch(layer, edit: str, batch: list):
+    # adds are not idempotent, so edits are only sent again when the service throttled them
+    result = request('edit', layer.edit_features, idempotent=False, **{edit: batch})
+    return sum(1 for outcome in result.get(edit[:-1] + 'Results', []) if outcome.get('success'))
+
+
+def apply_edits(layer, adds: list = (), updates: list = (), deletes: list = (),
+                batch_size: int = EDIT_BATCH_SIZE, max_workers: int = DEFAULT_WORKERS):
+    """
+    Sends adds, updates and deletes to a layer in fixed size batches, several batches at a time
+
+    Returns {'adds': n, 'updates': n, 'deletes': n} counting the edits the service accepted
+    """
+    deletes = [str(object_id) for object_id in deletes]
+    batches = [(edit, items[start:start + batch_size])
+               for edit, items in [('adds', list(adds)), ('updates', list(updates)), ('deletes', deletes)]
+               for start in range(0, len(items), batch_size)]
+
+    # edit_features takes deletes as a comma separated string of object IDs
+    batches = [(edit, ','.join(batch) if edit == 'deletes' else batch) for edit, batch in batches]
+
+    applied = {'adds': 0, 'updates': 0, 'deletes': 0}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        futures = [(edit, pool.submit(_edit_batch, layer, edit, batch)) for edit, batch in batches]
+        for edit, future in futures:
+            applied[edit] += future.result()
+
+    return applied
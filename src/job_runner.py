@@ -0,0 +1,103 @@
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+# jobs run at the same time, each job still uses its own --workers inside
+DEFAULT_JOB_WORKERS = 4
+
+
+def read_jobs(path: str):
+    """
+    Reads a JSONL job file, one job per line, blank lines and lines starting with # are skipped
+
+    example line: {"geocode": "data/Mobile Sites Mar 1.csv", "stream": true}
+
+    Returns a list of (line number, job dict)
+    """
+    jobs = []
+    with open(path) as file:
+        for number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            job = json.loads(line)
+            if not isinstance(job, dict):
+                raise ValueError('Line %d of %s is not a json object' % (number, path))
+            jobs.append((number, job))
+    return jobs
+
+
+def results_path(jobs_path: str):
+    """
+    example: results_path("jobs/nightly.jsonl") -> "jobs/nightly.results.jsonl"
+    """
+    return os.path.splitext(jobs_path)[0] + '.results.jsonl'
+
+
+def describe(result):
+    """
+    Json friendly summary of what a job returned: paths as they are, layer items by ID, tables by row count
+
+    example: describe({3.0: (table, total)}) -> {"3.0": [{"rows": 120}, {"rows": 1}]}
+    """
+    if result is None or isinstance(result, (str, int, float, bool)):
+        return result
+    if isinstance(result, (list, tuple)):
+        return [describe(value) for value in result]
+    if isinstance(result, dict):
+        # e.g. local_enrich and coverage return their tables by radius
+        return {str(key): describe(value) for key, value in result.items()}
+    if hasattr(result, 'id'):
+        return result.id
+    if hasattr(result, 'shape'):
+        return {'rows': int(result.shape[0])}
+    return str(result)
+
+
+def _timed(run_job, job: dict):
+    started = time.time()
+    try:
+        return {'status': 'ok', 'result': describe(run_job(job))}, started, time.time() - started
+    except Exception as error:
+        return ({'status': 'error', 'error': '%s: %s' % (type(error).__name__, error),
+                 'traceback': traceback.format_exc()}, started, time.time() - started)
+
+
+def run_jobs(jobs: list, run_job, output_path: str, max_workers: int = DEFAULT_JOB_WORKERS):
+    """
+    Runs jobs on a bounded thread pool and writes one result line per job as each one finishes
+
+    Args:
+        jobs (list): (line number, job dict) pairs, e.g. from read_jobs
+        run_job: runs one job dict and returns its output, errors are recorded instead of raised
+        output_path (str): JSONL results file, overwritten
+        max_workers (int): jobs run at the same time
+
+    Each result line holds the job's line number, the job, status ('ok' or 'error'), start
+    time, seconds taken and the result or error. Returns the results in job file order.
+    """
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    results = []
+
+    with open(output_path, 'w') as output, ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        futures = {pool.submit(_timed, run_job, job): (number, job) for number, job in jobs}
+
+        for future in as_completed(futures):
+            number, job = futures[future]
+            outcome, started, seconds = future.result()
+
+            result = {'line': number, 'job': job, 'status': outcome.pop('status'),
+                      'started': datetime.fromtimestamp(started).isoformat(timespec='seconds'),
+                      'seconds': round(seconds, 3)}
+            result.update(outcome)
+            print('Job on line', number, result['status'], 'in %.1fs' % seconds)
+
+            # written as jobs finish so a killed run still leaves the finished ones behind
+            output.write(json.dumps(result, default=str) + '\n')
+            output.flush()
+            results.append(result)
+
+    return sorted(results, key=lambda result: result['line'])
@@ -0,0 +1,137 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from .spatial import METERS_PER_MILE, PROJECTED_CRS, read_polygons
+
+VARIABLES_DIR = 'data/enrichment_variables'
+RACE_VARIABLES_PATH = VARIABLES_DIR + '/race_variables.txt'
+RACE_COLLECTION = 'agebyracebysex'
+
+# data collection each variable set in VARIABLES_DIR belongs to, and the title used for its layers.
+# sets not listed here must already hold full 'collection.VARIABLE' names
+VARIABLE_SETS = {
+    'race_variables': (RACE_COLLECTION, 'Age and Race by Sex'),
+}
+
+
+def load_variables(path: str = RACE_VARIABLES_PATH):
+    """
+    Reads a pickled list of esri variable names, e.g. ['MEDWAGE_CY', 'WHTM65_CY', ...]
+    """
+    with open(path, 'rb') as fp:
+        return pickle.load(fp)
+
+
+def load_variable_set(name: str):
+    """
+    Reads a variable set from VARIABLES_DIR as full enrich_layer variable names
+
+    example: load_variable_set('race_variables') -> ['agebyracebysex.MEDWAGE_CY', ...]
+    """
+    variables = load_variables(VARIABLES_DIR + '/' + name + '.txt')
+
+    if name in VARIABLE_SETS:
+        collection = VARIABLE_SETS[name][0]
+        variables = [collection + '.' + variable for variable in variables]
+
+    return variables
+
+
+def variable_set_title(name: str):
+    return VARIABLE_SETS[name][1] if name in VARIABLE_SETS else name.replace('_', ' ').title()
+
+
+def load_block_groups(polygons_path: str, demographics_path: str = None, key: str = 'GEOID'):
+    """
+    Loads block group polygons with their demographics, projected to an equal area crs
+
+    Args:
+        polygons_path (str): shapefile or GeoPackage of block groups
+        demographics_path (str): csv of counts per block group, joined on key. Leave out when the
+                                 polygons already carry the counts
+        key (str): block group id column shared by both files
+
+    Collection prefixes such as 'agebyracebysex.' are stripped from the demographic column names.
+    """
+    block_groups = read_polygons(polygons_path, PROJECTED_CRS)
+
+    if demographics_path is not None:
+        demographics = pd.read_csv(demographics_path, dtype={key: str})
+        block_groups[key] = block_groups[key].astype(str)
+        block_groups = block_groups[[key, block_groups.geometry.name]].merge(demographics, on=key)
+
+    return block_groups.rename(columns=lambda column: column.split('.')[-1])
+
+
+def apportion(zones, block_groups, variables: list):
+    """
+    Estimates block group counts inside each zone by the share of each block group's area the zone covers
+
+    Args:
+        zones: array of projected polygons, e.g. site buffers
+        block_groups: output of load_block_groups
+        variables (list): demographic columns to apportion
+
+    Returns an array of shape (len(zones), len(variables)). Count columns are apportioned by
+    area share. Median columns (MED...) cannot be added up, so they get the covered-area
+    weighted mean of the block group medians instead.
+    """
+    zones = np.asarray(zones)
+    block_geometry = np.asarray(block_groups.geometry)
+
+    tree = shapely.STRtree(block_geometry)
+    zone_index, block_index = tree.query(zones, predicate='intersects')
+
+    covered = shapely.area(shapely.intersection(zones[zone_index], block_geometry[block_index]))
+    share = covered / shapely.area(block_geometry)[block_index]
+
+    values = block_groups[variables].fillna(0).to_numpy(dtype=float)[block_index]
+    medians = np.array([variable.startswith('MED') for variable in variables])
+
+    weights = np.where(medians, covered[:, None], share[:, None])
+    totals = np.zeros((len(zones), len(variables)))
+    np.add.at(totals, zone_index, values * weights)
+
+    area = np.zeros(len(zones))
+    np.add.at(area, zone_index, covered)
+    totals[:, medians] /= np.where(area > 0, area, np.nan)[:, None]
+
+    return totals
+
+
+def enrich_sites(sites, block_groups, radii: list, variables: list):
+    """
+    Buffers sites by each radius and apportions block group demographics into the buffers
+
+    Args:
+        sites: point GeoDataFrame, e.g. read_points("output/csv/Geocoded Mobile Sites.csv")
+        block_groups: output of load_block_groups
+        radii (list): buffer distances in miles
+        variables (list): demographic columns to apportion
+
+    example: enrich_sites(sites, block_groups, [1, 3, 5], load_variables())
+
+    Returns {radius: DataFrame} shaped like the downloaded enrich_layer output: the site
+    columns, OBJECTID, bufferUnits, bufferRadii and one column per variable.
+    """
+    attributes = pd.DataFrame(sites.drop(columns=sites.geometry.name))
+    if 'OBJECTID' not in attributes:
+        attributes.insert(0, 'OBJECTID', np.arange(1, len(attributes) + 1))
+
+    points = np.asarray(sites.geometry.to_crs(PROJECTED_CRS))
+    enriched = {}
+
+    for radius in radii:
+        buffers = shapely.buffer(points, radius * METERS_PER_MILE)
+
+        table = attributes.copy()
+        table['bufferUnits'] = 'Miles'
+        table['bufferRadii'] = radius
+        table = table.join(pd.DataFrame(apportion(buffers, block_groups, variables),
+                                        columns=variables, index=table.index))
+        enriched[radius] = table
+
+    return enriched
@@ -0,0 +1,69 @@
+import hashlib
+import os
+
+from .cache import CACHE_DIR, fingerprint, load_json, save_json
+from .profiling import measure
+
+PIPELINE_DIR = CACHE_DIR + '/pipeline'
+
+
+def file_fingerprint(path: str, block_size: int = 1 << 20):
+    """
+    sha256 of a file's bytes, read in blocks so large csvs are not loaded at once
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def state_path(csv_path: str):
+    """
+    Where the pipeline state of an input csv is kept
+
+    example: state_path("data/Mobile Sites Mar 1.csv") -> "output/cache/pipeline/Mobile Sites Mar 1.json"
+    """
+    return PIPELINE_DIR + '/' + os.path.splitext(os.path.basename(csv_path))[0] + '.json'
+
+
+class PipelineState(object):
+    """
+    Remembers what each pipeline stage produced and a fingerprint of the inputs it was run with
+
+    Stages are saved as soon as they finish, so a run that fails part way resumes from the
+    stage that failed, and stages whose inputs did not change are skipped.
+    """
+    def __init__(self, path: str):
+
+        self.path = path
+        self.stages = load_json(path, {})
+
+    def get(self, stage: str):
+        return self.stages.get(stage, {}).get('output')
+
+    def run(self, stage: str, inputs, func, valid=None, refresh: bool = False):
+        """
+        Returns the stored output of stage when its inputs are unchanged, otherwise runs func and stores its output
+
+        Args:
+            stage (str): name of the stage, e.g. 'geocode'
+            inputs: json serializable values the stage output depends on
+            func: runs the stage, returns a json serializable output (paths, item IDs)
+            valid: optional check that a stored output still exists, e.g. the item was not deleted
+            refresh (bool): run the stage even if its inputs are unchanged
+        """
+        key = fingerprint(stage, inputs)
+        stored = self.stages.get(stage, {})
+
+        if not refresh and stored.get('key') == key and (valid is None or valid(stored['output'])):
+            print('Skipping', stage, '- inputs unchanged since the last run')
+            return stored['output']
+
+        print('Running', stage)
+        with measure('pipeline ' + stage):
+            output = func()
+
+        self.stages[stage] = {'key': key, 'output': output}
+        save_json(self.path, self.stages)
+        return output
@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# spans kept for the timeline, totals per stage keep counting past this
+MAX_EVENTS = 100000
+
+
+class Profiler(object):
+    """
+    Collects wall time per stage, remote requests, bytes transferred and credits for a --profile trace
+
+    Disabled until enable() is called, measure() then costs one flag check.
+    """
+    def __init__(self):
+
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self._origin = time.perf_counter()
+        self.stages = {}
+        self.requests = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.credits = {}
+        self.events = []
+
+    def enable(self):
+        self.reset()
+        self.enabled = True
+
+    def _span(self, name: str, start: float, seconds: float, args: dict):
+        if len(self.events) < MAX_EVENTS:
+            self.events.append({'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.get_ident(),
+                                'ts': round((start - self._origin) * 1e6), 'dur': round(seconds * 1e6),
+                                'args': args})
+
+    @contextmanager
+    def measure(self, name: str, rows: int = None):
+        """
+        Times the block as one call of stage name, rows can also be set on the yielded dict
+
+        example: with PROFILER.measure('read csv') as span: df = pd.read_csv(path); span['rows'] = len(df)
+        """
+        span = {'rows': rows}
+        if not self.enabled:
+            yield span
+            return
+
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                totals = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'rows': 0})
+                totals['calls'] += 1
+                totals['seconds'] += seconds
+                totals['rows'] += span['rows'] or 0
+                self._span(name, start, seconds, {key: value for key, value in span.items() if value is not None})
+
+    def request(self, endpoint: str, start: float, seconds: float, outcome: str):
+        """
+        Records one attempt of a remote call, outcome is 'ok', 'retried', 'throttled' or 'failed'
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            totals = self.requests.setdefault(endpoint, {'count': 0, 'seconds': 0.0, 'ok': 0, 'retried': 0,
+                                                         'throttled': 0, 'failed': 0})
+            totals['count'] += 1
+            totals['seconds'] += seconds
+            totals[outcome] += 1
+            self._span('request ' + endpoint, start, seconds, {'outcome': outcome})
+
+    def transferred(self, sent: int, received: int):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def watch_session(self, session):
+        """
+        Counts the bytes of every request a requests.Session sends and receives
+        """
+        if not self.enabled or session is None:
+            return
+
+        def count(response, *args, **kwargs):
+            body = getattr(response.request, 'body', None) or b''
+            length = response.headers.get('Content-Length')
+            self.transferred(len(body), int(length) if length else len(response.content or b''))
+
+        session.hooks.setdefault('response', []).append(count)
+
+    def record_credits(self, label: str, credits):
+        if self.enabled and credits is not None:
+            self.credits[label] = float(credits)
+
+    def trace(self, command: list = None):
+        """
+        The profile as a dict, also loadable as a Chrome / Perfetto trace through its traceEvents
+        """
+        with self._lock:
+            stages = {name: dict(totals, seconds=round(totals['seconds'], 4),
+                                 rows_per_second=round(totals['rows'] / totals['seconds'], 1)
+                                 if totals['rows'] and totals['seconds'] else None)
+                      for name, totals in self.stages.items()}
+            requests = {endpoint: dict(totals, seconds=round(totals['seconds'], 4))
+                        for endpoint, totals in self.requests.items()}
+
+            credits = dict(self.credits)
+            if 'start' in credits and 'end' in credits:
+                credits['used'] = round(credits['start'] - credits['end'], 3)
+
+            return {'command': command, 'started': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+                    'seconds': round(time.perf_counter() - self._origin, 4), 'stages': stages,
+                    'requests': requests, 'bytes': {'sent': self.bytes_sent, 'received': self.bytes_received},
+                    'credits': credits or None, 'traceEvents': list(self.events)}
+
+    def save(self, path: str, command: list = None):
+        """
+        Writes the trace as json and prints the time per stage, returns the trace
+        """
+        trace = self.trace(command)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(trace, file, indent=1, default=str)
+
+        for name, totals in sorted(trace['stages'].items(), key=lambda stage: -stage[1]['seconds']):
+            rate = '  %.0f rows/s' % totals['rows_per_second'] if totals['rows_per_second'] else ''
+            print('%-28s %5d calls %9.3fs%s' % (name, totals['calls'], totals['seconds'], rate))
+
+        requests = sum(totals['count'] for totals in trace['requests'].values())
+        print('%d requests, %d bytes received, %.3fs total, profile saved to %s'
+              % (requests, trace['bytes']['received'], trace['seconds'], path))
+        return trace
+
+
+# one profiler per process, shared by every module and thread
+PROFILER = Profiler()
+
+
+def measure(name: str, rows: int = None):
+    """
+    Times a stage on the shared profiler, a no-op unless --profile is on
+
+    example: with measure('write csv', rows=len(df)): df.to_csv(path)
+    """
+    return PROFILER.measure(name, rows)
@@ -0,0 +1,205 @@
+import email.utils
+import random
+import re
+import threading
+import time
+
+from .profiling import PROFILER
+
+# status codes worth another try, 429 and 503 also mean the service wants less traffic
+RETRY_STATUS = {429, 500, 502, 503, 504}
+THROTTLE_STATUS = {429, 503}
+
+MAX_RETRIES = 5
+BASE_DELAY = 1.0
+MAX_DELAY = 60.0
+
+# concurrency each endpoint starts at and may grow to, without throttling it adds one
+# request slot per window of successes and halves on every throttled response
+INITIAL_CONCURRENCY = 8
+MAX_CONCURRENCY = 64
+
+# network errors raised by requests / urllib3 under these names are always transient
+_TRANSIENT_ERRORS = {'ConnectionError', 'ConnectTimeout', 'ReadTimeout', 'Timeout', 'TimeoutError',
+                     'ChunkedEncodingError', 'ProtocolError', 'RemoteDisconnected'}
+_TRANSIENT_MESSAGE = re.compile(r'too many requests|rate limit|timed out|connection (reset|aborted)|'
+                                r'temporarily unavailable|try again later', re.IGNORECASE)
+
+
+def status_of(error: Exception):
+    """
+    HTTP status of a failed request, from the response it carries or an 'Error Code: 503' style message
+    """
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None)
+    if status is not None:
+        return int(status)
+
+    match = re.search(r'(?:error code|status(?: code)?|http)\W{0,3}(\d{3})\b', str(error), re.IGNORECASE)
+    return int(match.group(1)) if match else None
+
+
+def retry_after(error: Exception):
+    """
+    Seconds the service asked to wait in a Retry-After header, None when it did not say
+    """
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        date = email.utils.parsedate_to_datetime(value)
+        return max(0.0, date.timestamp() - time.time())
+
+
+def is_throttled(error: Exception):
+    return status_of(error) in THROTTLE_STATUS or retry_after(error) is not None or \
+        re.search(r'too many requests|rate limit', str(error), re.IGNORECASE) is not None
+
+
+def is_transient(error: Exception):
+    """
+    Whether a failed request may succeed if sent again: throttling, 5xx and dropped connections
+    """
+    if is_throttled(error) or status_of(error) in RETRY_STATUS:
+        return True
+    if type(error).__name__ in _TRANSIENT_ERRORS or isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    return _TRANSIENT_MESSAGE.search(str(error)) is not None
+
+
+class Endpoint(object):
+    """
+    Additive increase / multiplicative decrease concurrency limit for one kind of request
+
+    Callers hold a slot while their request is in flight. A throttled response halves the
+    limit and pauses the endpoint for the Retry-After time, so every thread backs off together.
+    """
+    def __init__(self, name: str, limit: float = INITIAL_CONCURRENCY, max_limit: float = MAX_CONCURRENCY):
+
+        self.name = name
+        self.limit = float(limit)
+        self.max_limit = float(max_limit)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.requests = 0
+        self.throttled = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, clock=time.monotonic):
+        with self._condition:
+            while True:
+                pause = self.paused_until - clock()
+                if pause > 0:
+                    self._condition.wait(pause)
+                elif self.in_flight >= max(1, int(self.limit)):
+                    self._condition.wait()
+                else:
+                    break
+            self.in_flight += 1
+            self.requests += 1
+
+    def release(self, throttled: bool = False, pause: float = 0.0, clock=time.monotonic):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                self.limit = max(1.0, self.limit / 2)
+                self.paused_until = max(self.paused_until, clock() + pause)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class Scheduler(object):
+    """
+    Sends requests through per endpoint concurrency limits, retrying transient failures
+    with jittered exponential backoff or the wait the service asked for in Retry-After
+    """
+    def __init__(self, max_retries: int = MAX_RETRIES, base_delay: float = BASE_DELAY,
+                 max_delay: float = MAX_DELAY, sleep=time.sleep):
+
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def endpoint(self, name: str):
+        with self._lock:
+            if name not in self.endpoints:
+                self.endpoints[name] = Endpoint(name)
+            return self.endpoints[name]
+
+    def backoff(self, attempt: int):
+        """
+        Full jitter: a random wait up to base_delay * 2 ** attempt, so retrying threads spread out
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, endpoint: str, func, *args, idempotent: bool = True, **kwargs):
+        """
+        Calls func(*args, **kwargs) as a request to endpoint, returns its result
+
+        Args:
+            endpoint (str): request kind sharing a concurrency limit, e.g. 'geocode' or 'query'
+            func: the remote call
+            idempotent (bool): False for calls that create something (publish, enrich, edits).
+                               They are only retried when throttled, since the service refused
+                               those before doing anything, never after a 5xx or dropped connection
+
+        Errors that are not transient, or still failing after max_retries, are raised.
+        """
+        limiter = self.endpoint(endpoint)
+
+        for attempt in range(self.max_retries + 1):
+            limiter.acquire()
+            start = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as error:
+                throttled = is_throttled(error)
+                retry = (throttled or (idempotent and is_transient(error))) and attempt < self.max_retries
+                wait = retry_after(error)
+                if wait is None:
+                    wait = self.backoff(attempt)
+
+                limiter.release(throttled=throttled, pause=wait if throttled else 0.0)
+                PROFILER.request(endpoint, start, time.perf_counter() - start,
+                                 'failed' if not retry else 'throttled' if throttled else 'retried')
+                if not retry:
+                    raise
+
+                print('%s request failed (%s), retry %d of %d in %.1fs'
+                      % (endpoint, error, attempt + 1, self.max_retries, wait))
+                self.sleep(wait)
+            else:
+                limiter.release()
+                PROFILER.request(endpoint, start, time.perf_counter() - start, 'ok')
+                return result
+
+    def stats(self):
+        """
+        {endpoint: {'requests': n, 'throttled': n, 'limit': current concurrency limit}}
+        """
+        with self._lock:
+            return {name: {'requests': limiter.requests, 'throttled': limiter.throttled,
+                           'limit': round(limiter.limit, 2)}
+                    for name, limiter in self.endpoints.items()}
+
+
+# one scheduler per process, so every thread and module shares the same limits
+SCHEDULER = Scheduler()
+
+
+def request(endpoint: str, func, *args, **kwargs):
+    """
+    Sends a remote call through the shared scheduler
+
+    example: request('query', layer.query, where='1=1', return_ids_only=True)
+    """
+    return SCHEDULER.call(endpoint, func, *args, **kwargs)
@@ -0,0 +1,85 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+# geocoder output is lon/lat
+GEOGRAPHIC_CRS = 'EPSG:4326'
+
+# California Albers, equal area in meters, used for distances, buffers and areas
+PROJECTED_CRS = 'EPSG:3310'
+
+METERS_PER_MILE = 1609.344
+
+
+def read_points(csv_path: str, x: str = 'X', y: str = 'Y'):
+    """
+    Reads a geocoded csv into a point GeoDataFrame, rows without coordinates are dropped
+
+    example: read_points("output/csv/Geocoded Mobile Sites.csv")
+    """
+    df = pd.read_csv(csv_path)
+    df = df[df[x].notna() & df[y].notna()].reset_index(drop=True)
+
+    return gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df[x], df[y]), crs=GEOGRAPHIC_CRS)
+
+
+def read_polygons(path: str, crs: str = None):
+    """
+    Reads a shapefile or GeoPackage of polygons, optionally reprojected to crs
+    """
+    polygons = gpd.read_file(path)
+    return polygons.to_crs(crs) if crs else polygons
+
+
+def join_points_to_polygons(points, polygons):
+    """
+    Attaches the attributes of the polygon each point falls in, points outside every polygon get empty values
+
+    Args:
+        points: point GeoDataFrame
+        polygons: polygon GeoDataFrame, e.g. zipcodes
+
+    example: join_points_to_polygons(read_points(csv_path), read_polygons("data/shp/zipcodes.gpkg"))
+
+    The polygons' STRtree index is queried with every point at once. A point on a shared
+    border is given to the first polygon it touches.
+    """
+    polygons = polygons.to_crs(points.crs)
+
+    point_index, polygon_index = polygons.sindex.query(points.geometry, predicate='intersects')
+    point_index, first = np.unique(point_index, return_index=True)
+    polygon_index = polygon_index[first]
+
+    attributes = pd.DataFrame(polygons.drop(columns=polygons.geometry.name)).iloc[polygon_index]
+    attributes.index = point_index
+
+    return points.join(attributes, rsuffix='_polygon')
+
+
+def within_radius(points, targets, miles: float, crs: str = PROJECTED_CRS):
+    """
+    Finds every (target, point) pair closer than miles, with the distance between them
+
+    Args:
+        points: point GeoDataFrame
+        targets: GeoDataFrame of any geometry, e.g. zipcode polygons or other sites
+        miles (float): search radius
+        crs (str): projected crs distances are measured in
+
+    example: within_radius(sites, zipcodes, 3)
+
+    Returns a DataFrame with target_index, point_index and distance_miles columns, the
+    indexes being row positions in targets and points
+    """
+    point_geometry = np.asarray(points.geometry.to_crs(crs))
+    target_geometry = np.asarray(targets.geometry.to_crs(crs))
+
+    tree = shapely.STRtree(point_geometry)
+    target_index, point_index = tree.query(target_geometry, predicate='dwithin',
+                                           distance=miles * METERS_PER_MILE)
+
+    distance = shapely.distance(target_geometry[target_index], point_geometry[point_index])
+
+    return pd.DataFrame({'target_index': target_index, 'point_index': point_index,
+                         'distance_miles': distance / METERS_PER_MILE})